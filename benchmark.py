@@ -0,0 +1,314 @@
+# Microbenchmarks for the CPU-bound helpers in main.py
+# Generates synthetic song libraries from config.toml's instrument names and times each helper at a few sizes,
+# then checks the times against benchmark_baselines.json so new quadratic loops show up before the weekly run does.
+# It also checks fast_page_count() against a few hand-made PDFs, since a wrong count there looks perfectly valid,
+# and that agenda links to library folders resolve to the right songs.
+#
+#   python benchmark.py                      Run 1k/10k/100k file libraries and compare with the baselines
+#   python benchmark.py --sizes 1000 10000   Only run some sizes
+#   python benchmark.py --update             Save this machine's times as the new baselines
+import argparse
+import builtins
+import copy
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import main
+
+BASELINES_PATH = 'benchmark_baselines.json'
+SCALING_SLACK = 2.0 # How much worse than linear a 10x bigger library is allowed to get before we complain
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Numbers of PDF files in the synthetic libraries")
+arg_parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, the fastest one counts")
+arg_parser.add_argument('--tolerance', type=float, default=2.0, help="Fail if a benchmark is this many times slower than its baseline")
+arg_parser.add_argument('--update', action="store_true", help="Save the measured times as the new baselines")
+arg_parser.add_argument('--only', nargs='+', default=[], help="Only run these benchmarks")
+
+TITLE_WORDS = ["Valerie", "Hey", "Ya", "Sweet", "Caroline", "Shake", "It", "Off", "Tubthumping", "Seven", "Nation",
+               "Army", "Uptown", "Funk", "Crazy", "In", "Love", "September", "Toxic", "Bad", "Romance", "Jolene"]
+
+# Instrument spellings as they might show up in PDF names, straight from config.toml
+def get_vocabulary():
+    part_names = [name for names in main.INSTRUMENTS.values() for name in names]
+    backup_names = [name for names in main.BACKUP_INSTRUMENTS.values() for name in names if name not in main.INSTRUMENTS]
+    solo_names = [name for names in main.SOLO_PARTS.values() for name in names]
+    return part_names, sorted(set(backup_names)), sorted(set(solo_names))
+
+# A synthetic library shaped like what query_tree returns, with roughly num_files PDFs
+def make_library(num_files, seed=0):
+    rng = random.Random(seed)
+    part_names, backup_names, solo_names = get_vocabulary()
+    songs = []
+    file_count = 0
+    while file_count < num_files:
+        title = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 3))) + " " + str(len(songs))
+        song = {'id': 'folder' + str(len(songs)), 'name': title, 'files': []}
+        for part in rng.sample(part_names, rng.randint(4, 10)):
+            style = rng.random()
+            if style < 0.5:
+                name = title + " - " + part + rng.choice(["", " 1", " 2"]) + ".pdf"
+            elif style < 0.8:
+                name = part + " - " + title + ".pdf"
+            else:
+                name = title.replace(' ', '_') + "_" + part.replace(' ', '_') + "_v" + str(rng.randint(1, 4)) + ".pdf"
+            song['files'].append(make_file(rng, name, file_count))
+            file_count += 1
+        extra = rng.random()
+        if extra < 0.2:
+            song['files'].append(make_file(rng, title + " - " + rng.choice(backup_names) + ".pdf", file_count))
+            file_count += 1
+        elif extra < 0.3:
+            song['files'].append(make_file(rng, rng.choice(solo_names) + " - " + title + ".pdf", file_count))
+            file_count += 1
+        elif extra < 0.35:
+            song['files'].append(make_file(rng, title + " - Lyrics.pdf", file_count))
+            file_count += 1
+        songs.append(song)
+    return songs
+
+def make_file(rng, src_name, n):
+    dest_name = main.sanitize_file_name(src_name)
+    modified = 1700000000000 + rng.randint(0, 10**10)
+    pagecount = rng.randint(1, 6)
+    return {
+        'id': 'file' + str(n),
+        'src_name': src_name,
+        'dest_name': dest_name,
+        'filehash': main.java_string_hashcode(dest_name),
+        'modifiedTime': modified,
+        'createdTime': modified - rng.randint(0, 10**9),
+        'size': str(rng.randint(20000, 2000000)),
+        'md5Checksum': '%032x' % rng.getrandbits(128),
+        'pagecount': pagecount,
+        'pageorder': '1-' + str(pagecount),
+    }
+
+# Songs linked from a fake agenda: mostly songs already in the library, plus a couple that aren't
+def make_setlist_songs(songs, seed=0):
+    rng = random.Random(seed)
+    setlist_songs = [copy.deepcopy(song) for song in rng.sample(songs, min(20, len(songs)))]
+    for i in range(2):
+        setlist_songs.append({'id': 'agenda' + str(i), 'name': 'Agenda Only Song ' + str(i), 'files': copy.deepcopy(songs[i]['files'])})
+    return setlist_songs
+
+def assemble_library(songs):
+    for song in songs:
+        main.assemble_song_parts(song)
+    main.get_song_preferred_names(songs)
+
+# Each benchmark is (setup, run). setup gets a fresh copy of the library and isn't timed.
+def setup_file_names(songs):
+    return [file['src_name'] for song in songs for file in song['files']]
+
+def run_extract_parts(file_names):
+    for file_name in file_names:
+        main.extract_parts_from_filename(file_name)
+
+def run_hashcode(file_names):
+    for file_name in file_names:
+        main.java_string_hashcode(file_name)
+
+def run_assemble_song_parts(songs):
+    for song in songs:
+        main.assemble_song_parts(song)
+
+def setup_assembled(songs):
+    for song in songs:
+        main.assemble_song_parts(song)
+    return songs
+
+def setup_setlist(songs):
+    return make_setlist_songs(songs), songs
+
+def run_insert_setlist(state):
+    setlist_songs, songs = state
+    main.insert_setlist_songs_into_songlist(setlist_songs, songs)
+
+def setup_database_rows(songs):
+    setlist_songs = make_setlist_songs(songs)
+    setlists = [{'name': 'Rehearsal', 'song_index': main.insert_setlist_songs_into_songlist(setlist_songs, songs)}]
+    assemble_library(songs)
+    part_folders = {part: {'id': 'partfolder_' + part.replace(' ', '_'), 'name': part} for part in main.INSTRUMENTS}
+    song_id_map = {}
+    for song in songs:
+        for file in song['files']:
+            song_id_map.setdefault(file['id'], len(song_id_map) + 1)
+    return songs, setlists, part_folders, song_id_map
+
+# The row and hashcodes generation from update_database, for every instrument, into in-memory copies of the template
+def run_database_rows(state):
+    songs, setlists, part_folders, song_id_map = state
+    template = sqlite3.connect('ltbb_blank.db')
+    connections = {}
+    for part in part_folders:
+        connections[part] = sqlite3.connect(':memory:')
+        template.backup(connections[part])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_files = {part: open(os.path.join(tmp_dir, part + '_hashcodes.txt'), "w", encoding="utf-8") for part in part_folders}
+        main.insert_library_rows({part: connections[part].cursor() for part in part_folders}, manifest_files, songs, setlists, part_folders, song_id_map)
+        for part in part_folders:
+            manifest_files[part].close()
+            connections[part].commit()
+            connections[part].close()
+    template.close()
+
+BENCHMARKS = {
+    'extract_parts_from_filename': (setup_file_names, run_extract_parts),
+    'java_string_hashcode': (setup_file_names, run_hashcode),
+    'assemble_song_parts': (lambda songs: songs, run_assemble_song_parts),
+    'find_partless_files': (setup_assembled, main.find_partless_files),
+    'get_song_preferred_names': (setup_assembled, main.get_song_preferred_names),
+    'build_coverage': (setup_assembled, main.build_coverage),
+    'insert_setlist_songs_into_songlist': (setup_setlist, run_insert_setlist),
+    'update_database_rows': (setup_database_rows, run_database_rows),
+}
+
+# Smallest PDF fast_page_count() can read: a catalog, a /Pages node with the given /Count entry and any extra objects
+def make_pdf(count_entry, extra_objects=[]):
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"<< /Type /Pages /Kids [] /Count " + count_entry + b" >>"] + extra_objects
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(data))
+        data += str(i + 1).encode() + b" 0 obj\n" + obj + b"\nendobj\n"
+    xref_offset = len(data)
+    data += b"xref\n0 " + str(len(objects) + 1).encode() + b"\n0000000000 65535 f \n"
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size " + str(len(objects) + 1).encode() + b" /Root 1 0 R >>\nstartxref\n" + str(xref_offset).encode() + b"\n%%EOF\n"
+    return data
+
+# Quick correctness checks for the fast paths, so a speedup can't quietly change results. Each is (input, expected).
+PAGE_COUNT_CHECKS = [
+    (make_pdf(b"12"), 12),
+    (make_pdf(b"3 0 R", [b"120"]), 120),
+    # Object numbers with more than one digit, which a sloppy regex reads as a count of 1
+    (make_pdf(b"12 0 R", [b"null"] * 9 + [b"7"]), 7),
+]
+
+def check_page_counts():
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (data, expected) in enumerate(PAGE_COUNT_CHECKS):
+            path = os.path.join(tmp_dir, str(i) + '.pdf')
+            with open(path, "wb") as f:
+                f.write(data)
+            count = main.fast_page_count(path)
+            if count != expected:
+                failures.append(f"fast_page_count read {count} pages from test PDF {i}, expected {expected}")
+    return failures
+
+# Agenda links to folders already in the library have to resolve to those songs, and links to other folders get listed
+def check_setlist_links():
+    library = make_library(100)
+    outside_files = copy.deepcopy(library[0]['files'])
+    stubs = {
+        'get_doc_folder_links': lambda doc_id: ['https://drive.google.com/drive/folders/' + folder_id for folder_id in ['folder3', 'outside', 'folder1']],
+        'get_folder_name': lambda folder_id: 'Outside Song',
+        'list_pdfs_in_folder': lambda folder_id: outside_files,
+    }
+    originals = {name: getattr(main, name) for name in stubs}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'songs.jsonl')
+        main.save_song_index(path, library)
+        songs = main.SongIndex(path)
+        builtins.print = quiet_print
+        try:
+            for name in stubs:
+                setattr(main, name, stubs[name])
+            setlists = main.query_setlist_docs({'Rehearsal': 'doc'}, songs)
+        except Exception as e:
+            return [f"query_setlist_docs failed on agenda links to library folders: {e!r}"]
+        finally:
+            builtins.print = main.my_log_print
+            for name in originals:
+                setattr(main, name, originals[name])
+        names = [songs[song_idx]['name'] for song_idx in setlists[0]['song_index']]
+        expected = [library[3]['name'], 'Outside Song', library[1]['name']]
+        if names != expected:
+            failures.append(f"Agenda links resolved to {names}, expected {expected}")
+        if len(songs) != len(library) + 1:
+            failures.append(f"Agenda links left {len(songs)} songs, expected {len(library) + 1}")
+    return failures
+
+def quiet_print(*args, **kwargs):
+    pass
+
+# Fastest of repeat runs, in seconds. main.py logs a lot, so printing is switched off while timing.
+def time_benchmark(name, library, repeat):
+    setup, run = BENCHMARKS[name]
+    best = None
+    for i in range(repeat):
+        builtins.print = quiet_print
+        try:
+            state = setup(copy.deepcopy(library))
+            start = time.perf_counter()
+            run(state)
+            elapsed = time.perf_counter() - start
+        finally:
+            builtins.print = main.my_log_print
+            main.error_log.clear()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main_benchmark():
+    bench_args = arg_parser.parse_args()
+    names = bench_args.only or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"[red]Unknown benchmark {name}, options are {list(BENCHMARKS)}")
+            return 1
+
+    results = {name: {} for name in names}
+    for size in sorted(bench_args.sizes):
+        print(f"[cyan]Library with {size} files", rule=True)
+        library = make_library(size)
+        for name in names:
+            results[name][str(size)] = time_benchmark(name, library, bench_args.repeat)
+            print(f"[magenta]{name}[/magenta]: [cyan]{results[name][str(size)] * 1000:.1f}[/cyan] ms")
+
+    failures = check_page_counts() + check_setlist_links()
+    # Scaling: time should grow about as fast as the library does
+    sizes = sorted(bench_args.sizes)
+    for name in names:
+        for small, big in zip(sizes, sizes[1:]):
+            small_time = results[name][str(small)]
+            big_time = results[name][str(big)]
+            if small_time > 0 and big_time / small_time > (big / small) * SCALING_SLACK:
+                failures.append(f"{name} got {big_time / small_time:.1f}x slower going from {small} to {big} files (expected about {big / small:.0f}x)")
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    if bench_args.update:
+        for name in names:
+            baselines.setdefault(name, {}).update(results[name])
+        main.save_dict(BASELINES_PATH, baselines)
+        print(f"[cyan]Saved baselines to [green]{BASELINES_PATH}")
+    else:
+        for name in names:
+            for size in results[name]:
+                baseline = baselines.get(name, {}).get(size)
+                if baseline is None:
+                    print(f"[yellow]No baseline for {name} at {size} files, run with --update to save one")
+                elif results[name][size] > baseline * bench_args.tolerance:
+                    failures.append(f"{name} at {size} files took {results[name][size] * 1000:.1f} ms, baseline is {baseline * 1000:.1f} ms")
+
+    print()
+    if failures:
+        print("[red]Performance regressions:", rule=True)
+        for failure in failures:
+            print("[red]" + failure)
+        return 1
+    print("[cyan]All benchmarks within tolerance!")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
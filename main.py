@@ -10,9 +10,14 @@ import requests
 import builtins
 import time
 import json
+import copy
+import csv
 import argparse
 import pathlib
 import webbrowser
+import mmap
+import hashlib
+import zlib
 import tomli
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -29,41 +34,83 @@ from rich.live import Live
 from rich.text import Text
 from dateutil import parser
 from PyPDF2 import PdfReader
-from threading import Lock
+from threading import Lock, Thread
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 
 # Command line arguments
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('--clean', action="store_true", help="Force a clean redownload of songs, clear local cache. This does NOT clean the Google Drive folder, do that manually if needed (it shouldn't be needed).") 
 arg_parser.add_argument('--skipquery', action="store_true", help="Used for inner dev loop. Stores the file metadata of the drive so we don't have to requery each song. But usually you want to requery.")
 arg_parser.add_argument('--skipupload', action="store_true", help="Used for inner dev loop. Skips uploading the databases files at the end.")
+arg_parser.add_argument('--skipinterim', action="store_true", help="Don't publish a setlist-only database before the rest of the library is done. By default the setlist songs go up first so they're usable before rehearsal.")
 arg_parser.add_argument('--verbose', action="store_true", help="Spit out extra info") 
-arg_parser.add_argument('--dedupe', action="store_true", help="For use when a part folder accidentally ends up with multiple copies of the same file. Shouldn't happen.") 
-args = arg_parser.parse_args()
-
-config = None
-with open("config.toml", "rb") as f:
-    config = tomli.load(f)
-
-# Relevant Google Drive folders - TODO read this from a .ini file instead
-WEEKLY_AGENDA_ID = config["drive_settings"]["Weekly_Agenda_ID"]
-SRC_MUSIC_FOLDER = config["drive_settings"]["Source_Music_Folder"] # The LTBB folder containing all the sheet music. Currently organized in folders like "A-C", "D-F", etc
-DEST_MUSIC_FOLDER = config["drive_settings"]["Destination_Music_Folder"] # The folder where the MobileSheets database and PDFs will end up
-SEASONAL_SONGS = config["drive_settings"]["Seasonal_Songs"] # Some subfolders that contain additional songs not in the alphabetic folders
-DRIVE_ID = config["drive_settings"]["Drive_ID"] # Quirk of using a Shared Drive, we sometimes need this
-IGNORE_FOLDERS = config["drive_settings"]["Ignore_Folders"]
-EXCEPTION_PARTS = config["exceptions"]
+arg_parser.add_argument('--dedupe', action="store_true", help="For use when a part folder accidentally ends up with multiple copies of the same file. Shouldn't happen. Like --gc but only for duplicates.") 
+arg_parser.add_argument('--gc', action="store_true", help="Clean up the part folders: trash PDFs whose source was deleted or renamed, and extra copies of the same file. Shows a summary and asks before trashing anything.")
+arg_parser.add_argument('--parts', nargs='+', default=[], help="Force these instruments to be rebuilt and re-uploaded even if nothing changed, e.g. --parts Trumpet \"Tenor Sax\". Use 'all' for every instrument.")
+arg_parser.add_argument('--watch', action="store_true", help="After the normal run, keep running and republish whenever the source Drive or the Weekly Agenda changes.")
+arg_parser.add_argument('--libraries', nargs='+', default=['config.toml'], help="Config files of the libraries to publish, e.g. --libraries config.toml gig.toml. They're run one after another in the same process, sharing the Drive crawl, PDF/page count caches and API clients.")
+arg_parser.add_argument('--interval', type=int, default=20, help="With --watch, how many seconds to wait between checks for changes.")
+arg_parser.add_argument('--debounce', type=int, default=10, help="With --watch, how many quiet seconds to wait for a burst of edits to finish before publishing.")
+# When imported (benchmarks, page count worker processes) just use the defaults instead of someone else's command line
+args = arg_parser.parse_args() if __name__ == '__main__' else arg_parser.parse_args([])
+
+# Each library (source folders, agenda, destination and instrumentation) is described by a config file.
+# load_library_config() sets the globals below from one, so a batch run can switch between libraries.
+CONFIG_PATH = 'config.toml'
 MAX_SONGS = 99999
-
-# Instrumentation - this could also possibly move to a .ini folder
-INSTRUMENTS = config["instrumentation"]["instruments"]
-BACKUP_INSTRUMENTS = config["instrumentation"]["backup_instruments"]
-SOLO_PARTS = config["instrumentation"]["solo_parts"]
-INSTRUMENT_LOOKUP = {}
-for main in INSTRUMENTS:
-    for sub in INSTRUMENTS[main]:
-        INSTRUMENT_LOOKUP[sub.lower()] = main
-
-# Globals for Drive access
+# Where this library's own state lives (its song list, journal, SongIds, output/ and so on). The default library keeps
+# it in the repo folder like always, other libraries in a batch run get libraries/<config name>/.
+LIBRARY_DIR = ''
+
+def library_path(path):
+    return os.path.join(LIBRARY_DIR, path) if LIBRARY_DIR else path
+
+def load_library_config(config_path):
+    global config, WEEKLY_AGENDA_ID, SRC_MUSIC_FOLDER, DEST_MUSIC_FOLDER, SEASONAL_SONGS, DRIVE_ID, IGNORE_FOLDERS, EXCEPTION_PARTS
+    global INSTRUMENTS, BACKUP_INSTRUMENTS, SOLO_PARTS, INSTRUMENT_LOOKUP, LIBRARY_DIR
+    global INSTRUMENT_BITS, ALL_INSTRUMENTS_MASK, REQUIRED_PARTS_MASK, COVERAGE_LABELS, LABEL_BITS, LABEL_PATTERNS, SOLO_LABEL_MASKS
+    with open(config_path, "rb") as f:
+        config = tomli.load(f)
+    LIBRARY_DIR = '' if os.path.abspath(config_path) == os.path.abspath(CONFIG_PATH) else os.path.join('libraries', Path(config_path).stem)
+
+    # Relevant Google Drive folders
+    WEEKLY_AGENDA_ID = config["drive_settings"]["Weekly_Agenda_ID"]
+    SRC_MUSIC_FOLDER = config["drive_settings"]["Source_Music_Folder"] # The LTBB folder containing all the sheet music. Currently organized in folders like "A-C", "D-F", etc
+    DEST_MUSIC_FOLDER = config["drive_settings"]["Destination_Music_Folder"] # The folder where the MobileSheets database and PDFs will end up
+    SEASONAL_SONGS = config["drive_settings"]["Seasonal_Songs"] # Some subfolders that contain additional songs not in the alphabetic folders
+    DRIVE_ID = config["drive_settings"]["Drive_ID"] # Quirk of using a Shared Drive, we sometimes need this
+    IGNORE_FOLDERS = config["drive_settings"]["Ignore_Folders"]
+    EXCEPTION_PARTS = config["exceptions"]
+
+    # Instrumentation
+    INSTRUMENTS = config["instrumentation"]["instruments"]
+    BACKUP_INSTRUMENTS = config["instrumentation"]["backup_instruments"]
+    SOLO_PARTS = config["instrumentation"]["solo_parts"]
+    INSTRUMENT_LOOKUP = {}
+    for main in INSTRUMENTS:
+        for sub in INSTRUMENTS[main]:
+            INSTRUMENT_LOOKUP[sub.lower()] = main
+
+    # Song x instrument coverage is kept as bitmasks (bit i is the i-th instrument), so a whole row or column can be
+    # combined with one integer operation instead of nested loops over songs, parts and files.
+    INSTRUMENT_BITS = {part: 1 << i for i, part in enumerate(INSTRUMENTS)}
+    ALL_INSTRUMENTS_MASK = (1 << len(INSTRUMENTS)) - 1
+    REQUIRED_PARTS_MASK = ALL_INSTRUMENTS_MASK & ~sum(INSTRUMENT_BITS.get(part, 0) for part in OPTIONAL_PARTS)
+    # Backup and soloist names get tested against file names too, each one gets a bit in a file's label mask
+    COVERAGE_LABELS = list(dict.fromkeys([label for part in INSTRUMENTS for label in BACKUP_INSTRUMENTS[part] + SOLO_PARTS[part]]))
+    LABEL_BITS = {label: 1 << i for i, label in enumerate(COVERAGE_LABELS)}
+    # Same normalization as filename_contains(), done once up front
+    LABEL_PATTERNS = [(label.lower().replace(' ', '_'), LABEL_BITS[label]) for label in COVERAGE_LABELS]
+    SOLO_LABEL_MASKS = {part: sum(LABEL_BITS[label] for label in SOLO_PARTS[part]) for part in INSTRUMENTS}
+
+OPTIONAL_PARTS = ['Flute', 'Percussion', 'Score'] # Nobody gets warned about these being missing
+load_library_config(CONFIG_PATH)
+
+# Globals for Drive access, set up when the script is run (not when it's imported by benchmark.py)
+creds = None
+docs = None
+drive = None
 def get_creds():
     creds = None
     SCOPES = ["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/documents.readonly"]
@@ -83,9 +130,6 @@ def get_creds():
         with open("token.json", "w") as token:
             token.write(creds.to_json())
     return creds
-creds = get_creds()
-docs = build("docs", "v1", credentials=creds)
-drive = build("drive", "v3", credentials=creds)
 
 # Globals for logging
 def my_log_print(*args, print_to_std_out=True, save_to_file=True, live=None, rule=False, **kwargs):
@@ -113,63 +157,72 @@ builtins.print = my_log_print
 ######## Main Execution Starts Here!!! ########
 ###############################################
 def main():
-    # Clean download cache
-    if args.clean:
-        if os.path.exists('cache'):
-            shutil.rmtree('cache')
+    os.makedirs(library_path('cache'), exist_ok=True)
+    os.makedirs(library_path('output'), exist_ok=True)
+    load_journal()
+
+    # Grab the changes feed position before querying, so watch mode doesn't miss edits made during the first run
+    changes_page_token = None
+    if args.watch:
+        changes_page_token = get_start_page_token()
 
     # Assemble song list
-    songs = []
     push_log_section('[cyan]Querying LTBB Drive', rule=True)
 
-    cache = None
-    try:    
-        cache = load_dict('cache/cache.json')
+    setlists = None
+    try:
+        setlists = load_dict(library_path(SETLISTS_PATH))
     except json.decoder.JSONDecodeError as e:
-        cache = None
-    if args.skipquery and cache and 'songs' in cache and 'setlists' in cache:
+        setlists = None
+    if args.skipquery and setlists is not None and os.path.exists(library_path(SONG_INDEX_PATH)):
         # For inner dev loop, we can skip the query of the google drive folders and docs
         print('[cyan]Loading songs from cached file!')
-        songs = cache['songs']
-        setlists = cache['setlists']
+        songs = SongIndex(library_path(SONG_INDEX_PATH))
     else:
-        # Query the LTBB main Drive for one gazillion PDFs
-        songs = query_tree([SRC_MUSIC_FOLDER, SEASONAL_SONGS])
-        remove_duplicate_dicts(songs)
+        # Query the LTBB main Drive for one gazillion PDFs, writing the songs out as they're found
+        save_song_index(library_path(SONG_INDEX_PATH), query_tree([SRC_MUSIC_FOLDER, SEASONAL_SONGS]))
+        songs = SongIndex(library_path(SONG_INDEX_PATH))
         # Read the rehearsal schedule, modify songs if needed
         setlists = query_setlist_docs({"Rehearsal": WEEKLY_AGENDA_ID}, songs)
-        # Cache the result of the queries for inner dev loop
-        os.makedirs('cache', exist_ok=True)
-        os.makedirs('output', exist_ok=True)
-        save_dict('cache/cache.json', {'songs':songs, 'setlists':setlists})
+        # Cache the result of the queries for inner dev loop (this also drops the lines of songs the setlists replaced)
+        songs.rewrite()
+        save_dict(library_path(SETLISTS_PATH), setlists)
+        save_filehashes()
     pop_log_section(rule=True)
     print("[cyan]Done querying!")
     time.sleep(1)
 
     # Figure out the instrumentation from each songs' filenames
+    # From here on the run works from its own copy of the song index, with the parts filled in
     print()
     push_log_section('[cyan]Assembling part information', rule=True)
-    for song in songs:
+    partless_files = []
+    def assemble_song(song_idx, song):
         push_log_section("Instrumentation for [green]" + song['name'])
         assemble_song_parts(song)
         pop_log_section()
+        partless_files.extend(file['src_name'] for file in find_partless_files([song]))
+        # Rename all files of the form 'Instrument - SongTitle.pdf" into "SongTitle - Instrument.pdf" because then they'll be alphabetical
+        get_song_preferred_names([song])
+    songs.rewrite(assemble_song, library_path(SONG_PARTS_INDEX_PATH))
     pop_log_section(rule=True)
     print("[cyan]Part information assembled!")
 
     # Warn about files missing instruments
-    partless_files = find_partless_files(songs)
     if len(partless_files) > 0:
         warn('[yellow]Some files were not associated with any instrument (they might be Conductor Scores):', silent=True)
-        for file in partless_files:
-            warn(    '[yellow]    ' + file['src_name'], silent=True)
-    print("[cyan]See part information at [green]cache/songs_with_parts.json")
-    save_dict('cache/songs_with_parts.json', songs)
+        for src_name in partless_files:
+            warn(    '[yellow]    ' + src_name, silent=True)
+    print("[cyan]See part information at [green]" + library_path(SONG_PARTS_INDEX_PATH))
+    coverage = build_coverage(songs)
+    export_coverage(songs, coverage, library_path(COVERAGE_PATH))
+    print("[cyan]See which songs have parts for which instruments at [green]" + library_path(COVERAGE_PATH))
     time.sleep(1)
 
-    # Rename all files of the form 'Instrument - SongTitle.pdf" into "SongTitle - Instrument.pdf" because then they'll be alphabetical
-    get_song_preferred_names(songs)
+    # The same PDF can live in several song folders, only download/count/copy it once
+    dedupe_library_content(songs)
 
-    # Find destination part Drive folder IDs and existing files
+    # Find destination part Drive folder IDs
     print()
     push_log_section("[cyan]Querying destination part folders...", rule=True)
     part_folders = {}
@@ -177,53 +230,90 @@ def main():
         push_log_section("Finding part folder [magenta]" + part)
         folder = get_or_create_folder(part, DEST_MUSIC_FOLDER)
         stamps_folder = get_or_create_folder('stamps', folder['id'])
-        folder['files'] = list_pdfs_in_folder(folder['id'])
         part_folders[part] = folder
-        print("Found " + str(len(folder['files'])) + " existing PDFs")
         pop_log_section()
     pop_log_section(rule=True)
 
-    # Dedupe files in the Google Drive (shouldn't need to happen)
-    if args.dedupe:
-        push_log_section("[cyan]Deduping files, because somehow Geoffrey ended up getting multiple copies of the same PDF into a part folder.", rule=True)
-        for part in part_folders:
-            dedupe_files(part_folders[part])
-        pop_log_section(rule=True)
+    # Figure out which instruments actually changed since the last publish
+    fingerprints = get_instrument_fingerprints(songs, setlists, part_folders)
+    dirty_instruments = find_dirty_instruments(fingerprints, songs, args.parts)
+    if dirty_instruments:
+        print(f"[cyan]{len(dirty_instruments)}[/cyan] instruments changed: [magenta]{', '.join(sorted(dirty_instruments))}")
+    else:
+        print("[cyan]No instruments changed since the last run!")
+
+    # Find existing files in the part folders we're going to touch
+    push_log_section("[cyan]Listing existing files in part folders...", rule=True)
+    for part in part_folders:
+        if part in dirty_instruments:
+            part_folders[part]['files'] = list_pdfs_in_folder(part_folders[part]['id'])
+            print("Found " + str(len(part_folders[part]['files'])) + " existing PDFs for [magenta]" + part)
+    pop_log_section(rule=True)
+
+    # Setlist songs go first in every stage, so players get them well before the rest of the library is done
+    song_order = get_song_priority_order(songs, setlists)
+    setlist_song_count = len(get_setlist_song_indices(setlists))
+    setlist_song_indices = song_order[:setlist_song_count]
+    other_song_indices = song_order[setlist_song_count:]
+    # Same as the instrument fingerprints, but only for the setlists and the songs in them
+    setlist_fingerprints = get_instrument_fingerprints(songs, setlists, part_folders, song_indices=setlist_song_indices)
 
     # Copy files from Src drive folder to Destination drive folder 
     # Skips if the Src song is not newer than the Dest song
     print()
-    push_log_section('[cyan]Copying songs from source folders into destination part folders...', rule=True)
-    copy_songlist_into_drive(songs, part_folders)
+    push_log_section('[cyan]Copying setlist songs into destination part folders...', rule=True)
+    copy_songlist_into_drive((songs[song_idx] for song_idx in setlist_song_indices), part_folders, dirty_instruments)
+    pop_log_section(rule=True)
+
+    # If the setlist changed, publish the last published database with just the setlist songs updated. That uploads
+    # while we copy and count the rest of the library.
+    interim_publisher = None
+    if not args.skipupload and not args.skipinterim and setlist_song_indices and other_song_indices:
+        interim_instruments = find_interim_instruments(dirty_instruments, fingerprints, setlist_fingerprints)
+        if interim_instruments:
+            print()
+            push_log_section("[cyan]Publishing setlist songs early...", rule=True)
+            update_database(songs, setlists, part_folders, instruments=interim_instruments, upload=False, song_indices=setlist_song_indices, published_base=True)
+            interim_publisher = publish_in_background(interim_instruments, part_folders)
+            pop_log_section(rule=True)
+            print(f"[cyan]Uploading setlist updates for [magenta]{len(interim_instruments)}[/magenta] instruments in the background")
+
+    print()
+    push_log_section('[cyan]Copying the rest of the songs into destination part folders...', rule=True)
+    copy_songlist_into_drive((songs[song_idx] for song_idx in other_song_indices), part_folders, dirty_instruments)
     pop_log_section(rule=True)
     print('[cyan]Songs copied into Drive!')
     time.sleep(1)
+
+    # Trash orphaned and duplicate PDFs in the part folders
+    if args.gc or args.dedupe:
+        print()
+        push_log_section("[cyan]Cleaning up part folders...", rule=True)
+        collect_part_folder_garbage(songs, part_folders, orphans=args.gc)
+        pop_log_section(rule=True)
         
     # Update MobileSheets Database and upload
     print()
     push_log_section("[cyan]Updating databases...", rule=True)
-    if not args.skipupload:
-        update_database(songs, setlists, part_folders)
+    if interim_publisher:
+        # The full build clears output/, so let the setlist databases finish uploading first
+        print("Waiting for the setlist databases to finish uploading...")
+        interim_publisher.join()
+        if interim_publisher.failed_instruments:
+            warn(f"Setlist songs weren't published early for [magenta]{', '.join(interim_publisher.failed_instruments)}[/magenta], they'll go up with the full build")
+        else:
+            print("[cyan]Setlist songs published!")
+    if not args.skipupload and dirty_instruments:
+        built_instruments = update_database(songs, setlists, part_folders, instruments=dirty_instruments, fingerprints=fingerprints, song_indices=song_order)
+        save_instrument_fingerprints(fingerprints, built_instruments)
+        save_instrument_fingerprints(setlist_fingerprints, built_instruments, SETLIST_STATE_PATH)
+    clear_journal()
     pop_log_section(rule=True)
     print("[cyan]Database updated!")
     time.sleep(1)
 
     # Detect instruments that are missing parts for a song in the setlist
-    for setlist in setlists:
-        missing_parts = []
-        for song_idx in setlist['song_index']:
-            song = songs[song_idx]
-            missing_part = {'name':song['name'], 'parts':[]}
-            for part_key in part_folders:
-                if part_key not in song['parts'] and part_key not in ['Flute', 'Score', 'Percussion']:
-                    missing_part['parts'].append(part_key)
-            if missing_part['parts']:
-                missing_parts.append(missing_part)
-        if missing_parts:
-            warn(f'[yellow]Setlist [cyan]{setlist['name']}[/cyan] is missing parts in the following songs:', silent=True)
-            warn('[yellow](Geoffrey can help get this sorted out)', silent=True)
-            for missing_part in missing_parts:
-                error(f'    [green]{missing_part['name']}[/green]: ' + str(missing_part['parts']), silent=True)
+    report_missing_setlist_parts(songs, setlists, coverage)
 
     # Print errors
     if error_log:
@@ -234,6 +324,158 @@ def main():
     else:
         print("0 warnings or errors, great job!")
 
+    if args.watch:
+        print()
+        # Watch mode keeps going for hours and touches a few songs at a time, so it keeps the whole list in memory
+        watch_for_changes(list(songs), setlists, part_folders, changes_page_token)
+
+# Indexes of the songs in any setlist, in setlist order
+def get_setlist_song_indices(setlists):
+    return list(dict.fromkeys(song_idx for setlist in setlists for song_idx in setlist['song_index']))
+
+# Every song index, setlist songs first and then the rest of the library in its usual order
+def get_song_priority_order(songs, setlists):
+    setlist_song_indices = get_setlist_song_indices(setlists)
+    in_setlist = set(setlist_song_indices)
+    return setlist_song_indices + [song_idx for song_idx in range(len(songs)) if song_idx not in in_setlist]
+
+# Instruments worth an early setlist publish: ones whose setlist entries or setlist files changed since the last full
+# publish, and that have a copy of that publish to build on (so nothing disappears from the tablets in the meantime).
+# Instruments an interrupted run already built aren't rebuilt, so they're left alone too.
+def find_interim_instruments(dirty_instruments, fingerprints, setlist_fingerprints):
+    state = load_dict(library_path(SETLIST_STATE_PATH)) or {}
+    interim_instruments = set()
+    for instrument in dirty_instruments:
+        stem = instrument.replace(' ','_').lower()
+        if state.get(instrument) == setlist_fingerprints[instrument]:
+            continue
+        if journal_get('built', instrument) == fingerprints[instrument]:
+            continue
+        if not os.path.exists(library_path(UPLOADED_DATABASES_DIR + '/' + stem + '.db')) or not os.path.exists(library_path(UPLOADED_MANIFESTS_DIR + '/' + stem + '_hashcodes.txt')):
+            continue
+        interim_instruments.add(instrument)
+    return interim_instruments
+
+def report_missing_setlist_parts(songs, setlists, coverage):
+    for setlist in setlists:
+        # How many of the setlist's songs each instrument has, as one AND per column
+        setlist_mask = 0
+        for song_idx in setlist['song_index']:
+            setlist_mask |= 1 << song_idx
+        setlist_size = setlist_mask.bit_count()
+        print(f"Coverage for setlist [cyan]{setlist['name']}[/cyan]: " + ", ".join(f"[magenta]{part}[/magenta] {(coverage['columns'][part] & setlist_mask).bit_count()}/{setlist_size}" for part in INSTRUMENTS))
+
+        missing_parts = []
+        for song_idx in setlist['song_index']:
+            missing = REQUIRED_PARTS_MASK & ~coverage['rows'][song_idx]
+            if missing:
+                missing_parts.append({'name':songs[song_idx]['name'], 'parts':parts_in_mask(missing)})
+        if missing_parts:
+            warn(f'[yellow]Setlist [cyan]{setlist['name']}[/cyan] is missing parts in the following songs:', silent=True)
+            warn('[yellow](Geoffrey can help get this sorted out)', silent=True)
+            for missing_part in missing_parts:
+                error(f'    [green]{missing_part['name']}[/green]: ' + str(missing_part['parts']), silent=True)
+
+INSTRUMENT_STATE_PATH = 'cache/instrument_state.json'
+SETLIST_STATE_PATH = 'cache/setlist_state.json' # Same, but only covering the setlists, see find_interim_instruments()
+COVERAGE_PATH = 'coverage.csv'
+
+# Hashes everything that ends up in each instrument's database and part folder: its part folder, the files assigned
+# to it and their metadata, and its setlist entries. Page counts aren't known yet at this point, but they can only
+# change along with a file's content.
+# song_indices limits which songs' files count (default is every song).
+# Returns a dict of instrument to fingerprint.
+def get_instrument_fingerprints(songs, setlists, part_folders, song_indices=None):
+    # Each instrument's inputs are hashed as they come, laid out as one JSON list
+    hashes = {part: hashlib.sha1(('[' + json.dumps(part_folders[part]['id'])).encode()) for part in part_folders}
+    def add_input(part, value):
+        hashes[part].update((', ' + json.dumps(value)).encode())
+    for song in (songs if song_indices is None else (songs[song_idx] for song_idx in song_indices)):
+        for part in song['parts']:
+            for file in song['parts'][part]:
+                # The checksum rather than modifiedTime, so touching a file without changing it doesn't republish anything
+                add_input(part, [file['id'], file['dest_name'], file.get('preferred_name'), file.get('md5Checksum') or file['modifiedTime'], file['createdTime'], file['size'], content_source(file)['id']])
+    for setlist in setlists:
+        for part in hashes:
+            add_input(part, ['setlist', setlist['name']])
+        for song_idx in setlist['song_index']:
+            song = songs[song_idx]
+            for part in song['parts']:
+                add_input(part, [file['id'] for file in song['parts'][part]])
+    for part in hashes:
+        hashes[part].update(b']')
+    return {part: hashes[part].hexdigest() for part in hashes}
+
+# An instrument is dirty if its fingerprint changed since it was last published, or if it was asked for in forced_parts
+# (--parts). Instruments that have never had a part are left alone, like before.
+def find_dirty_instruments(fingerprints, songs, forced_parts=()):
+    state = load_dict(library_path(INSTRUMENT_STATE_PATH)) or {}
+    used_instruments = set(part for song in songs for part in song['parts'])
+    dirty = set()
+    for part in fingerprints:
+        if part not in used_instruments and part not in state:
+            continue
+        if state.get(part) != fingerprints[part]:
+            dirty.add(part)
+    for forced in forced_parts:
+        if forced.lower() == 'all':
+            dirty.update(fingerprints)
+            continue
+        matches = [part for part in fingerprints if part.lower() == forced.lower()]
+        if matches:
+            dirty.update(matches)
+        else:
+            warn("--parts: no instrument called [magenta]" + forced + "[/magenta], options are " + str(list(fingerprints)))
+    return dirty
+
+# Record what we published, so the next run can skip instruments that haven't changed
+def save_instrument_fingerprints(fingerprints, instruments, path=INSTRUMENT_STATE_PATH):
+    state = load_dict(library_path(path)) or {}
+    for part in instruments:
+        state[part] = fingerprints[part]
+    save_dict(library_path(path), state)
+
+# The file whose bytes we actually download, count and copy for this file.
+# That's the file itself, unless dedupe_library_content found an identical file elsewhere in the library.
+def content_source(file):
+    return file.get('canonical', file)
+
+# Library-wide dedupe by md5Checksum/size. Every file with the same content as an earlier file gets a 'canonical'
+# pointing at that first one, which is then used for downloads, page counts and Drive copies.
+# Songs keep their own files, so each song still shows up in MobileSheets under its own name.
+def dedupe_library_content(songs):
+    # Count first, so only content that actually shows up more than once has to be remembered
+    content_counts = {}
+    for song in songs:
+        for file in song['files']:
+            if file.get('md5Checksum'):
+                content_key = (file['md5Checksum'], file['size'])
+                content_counts[content_key] = content_counts.get(content_key, 0) + 1
+    by_content = {}
+    duplicates = 0
+    saved_bytes = 0
+    saved_calls = 0
+    def dedupe_song(song_idx, song):
+        nonlocal duplicates, saved_bytes, saved_calls
+        for file in song['files']:
+            file.pop('canonical', None)
+            if not file.get('md5Checksum') or content_counts[(file['md5Checksum'], file['size'])] < 2:
+                continue
+            canonical = by_content.setdefault((file['md5Checksum'], file['size']), file)
+            if canonical is file:
+                continue
+            file['canonical'] = canonical
+            duplicates += 1
+            saved_bytes += int(file['size'])
+            # One download, plus one copy for every part folder it would have gone into
+            saved_calls += 1 + sum(1 for part in song['parts'] if any(f is file for f in song['parts'][part]))
+            if args.verbose:
+                print(f"[green]{file['src_name']}[/green] in [green]{song['name']}[/green] is the same PDF as [green]{canonical['src_name']}")
+    update_songs(songs, dedupe_song)
+    if duplicates:
+        print(f"[cyan]{duplicates}[/cyan] duplicate PDFs in the library, saving [cyan]{saved_bytes / 1024 / 1024:.1f}[/cyan] MB of downloads and up to [cyan]{saved_calls}[/cyan] Drive API calls")
+    return duplicates
+
 def get_song_preferred_names(songs):
     possible_instruments = [key.lower().replace(' ', '_') for key in INSTRUMENT_LOOKUP]
     for key in BACKUP_INSTRUMENTS:
@@ -306,9 +548,14 @@ def stringify_print(*args, highlight=False, **kwargs):
     return buf.getvalue()
 
 # Used for caching queries (internal dev loop only) and saving log data
+# Writes to a temp file and renames it over the old one, so a crash never leaves a half-written file behind
 def save_dict(path, data):
-    with open(path, "w", encoding="utf-8") as f:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 def load_dict(path):
     if not os.path.exists(path):
@@ -316,6 +563,155 @@ def load_dict(path):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
+# The song list is saved one song per line, so it gets written and read back one song at a time instead of as
+# one giant JSON document
+SONG_INDEX_PATH = 'cache/songs.jsonl'
+SONG_PARTS_INDEX_PATH = 'cache/songs_with_parts.jsonl' # The songs with their parts and everything else the run works out
+SETLISTS_PATH = 'cache/setlists.json'
+
+# One line of a song index. Parts are saved as the IDs of the song's files, so they point at the same file dicts
+# again once the song is read back.
+def dump_song(song):
+    if 'parts' in song:
+        song = dict(song, parts={part: [file['id'] for file in song['parts'][part]] for part in song['parts']})
+    return (json.dumps(song, ensure_ascii=False) + '\n').encode('utf-8')
+
+def load_song(line):
+    song = json.loads(line)
+    if 'parts' in song:
+        files = {file['id']: file for file in song['files']}
+        song['parts'] = {part: [files[file_id] for file_id in song['parts'][part]] for part in song['parts']}
+    return song
+
+def save_song_index(path, songs):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, "wb") as f:
+        for song in songs:
+            f.write(dump_song(song))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def iter_song_index(path):
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield load_song(line)
+
+# The song list, read from a song index one song at a time. Only where each song's line starts is kept in memory, so
+# the library-wide steps can go through tens of thousands of songs without holding them all.
+# Songs read from it are fresh copies, so changes to them have to go through update_songs().
+class SongIndex:
+    def __init__(self, path):
+        self.path = path
+        self.load_offsets()
+
+    def load_offsets(self):
+        self.offsets = array('q')
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+
+    def read_song(self, f, song_idx):
+        f.seek(self.offsets[song_idx])
+        return load_song(f.readline())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, song_idx):
+        with open(self.path, "rb") as f:
+            return self.read_song(f, song_idx)
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for song_idx in range(len(self.offsets)):
+                yield self.read_song(f, song_idx)
+
+    # Replacing or adding a song writes it at the end of the file. A replaced song's old line stays behind until the
+    # next rewrite(), so don't open the file as a new SongIndex before then.
+    def __setitem__(self, song_idx, song):
+        self.offsets[song_idx] = self.write_song(song)
+
+    def append(self, song):
+        self.offsets.append(self.write_song(song))
+
+    def write_song(self, song):
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(dump_song(song))
+        return offset
+
+    # Streams every song through update(song_idx, song) into path (default is this index's own file), which this
+    # index then reads from
+    def rewrite(self, update=None, path=None):
+        def updated_songs():
+            for song_idx, song in enumerate(self):
+                if update:
+                    update(song_idx, song)
+                yield song
+        path = path or self.path
+        save_song_index(path, updated_songs())
+        self.path = path
+        self.load_offsets()
+
+# Runs update(song_idx, song) on every song and keeps the changes, whether songs is a list or a SongIndex
+def update_songs(songs, update):
+    if isinstance(songs, SongIndex):
+        songs.rewrite(update)
+        return
+    for song_idx, song in enumerate(songs):
+        update(song_idx, song)
+
+# Run journal, so an interrupted run can pick up where it left off.
+# Sections: 'copies', 'downloads', 'built' and 'uploaded', each a dict of key to the value it was recorded with
+# (a modifiedTime or an instrument fingerprint), so entries only count if the inputs haven't changed since.
+JOURNAL_PATH = 'cache/journal.json'
+JOURNAL_SAVE_EVERY = 25 # Records between saves. The rest get saved by flush_journal() on the way out.
+run_journal = None
+journal_unsaved = 0
+
+def load_journal():
+    global run_journal
+    try:
+        run_journal = load_dict(library_path(JOURNAL_PATH)) or {}
+    except json.decoder.JSONDecodeError:
+        run_journal = {}
+    if run_journal:
+        print("[cyan]Resuming an interrupted run: " + ", ".join(f"{len(run_journal[section])} {section}" for section in run_journal))
+
+def journal_get(section, key):
+    if run_journal is None:
+        return None
+    return run_journal.get(section, {}).get(key)
+
+def journal_record(section, key, value, flush=False):
+    global journal_unsaved
+    if run_journal is None:
+        return
+    run_journal.setdefault(section, {})[key] = value
+    journal_unsaved += 1
+    if flush or journal_unsaved >= JOURNAL_SAVE_EVERY:
+        flush_journal()
+
+def flush_journal():
+    global journal_unsaved
+    if run_journal is None or journal_unsaved == 0:
+        return
+    os.makedirs(library_path('cache'), exist_ok=True)
+    save_dict(library_path(JOURNAL_PATH), run_journal)
+    journal_unsaved = 0
+
+# Called once a run has finished, so the next one starts fresh
+def clear_journal():
+    global run_journal
+    run_journal = None
+    if os.path.exists(library_path(JOURNAL_PATH)):
+        os.remove(library_path(JOURNAL_PATH))
+
 MAX_RETRIES = 5
 BASE_DELAY = 1  # seconds
 def drive_list_with_retry(drive, **kwargs):
@@ -334,7 +730,7 @@ def drive_list_with_retry(drive, **kwargs):
 
 
 # Runs a Google Drive files() query and handles large numbers of files. Returns the list of files.
-def query_drive_files(query, fields):
+def query_drive_files(query, fields, service=None):
     page_token = None
     files = []
 
@@ -343,7 +739,7 @@ def query_drive_files(query, fields):
 
     while True:
         response = drive_list_with_retry(
-            drive,
+            service or drive,
             q=query,
             includeItemsFromAllDrives=True,
             supportsAllDrives=True,
@@ -374,7 +770,7 @@ def sanitize_file_name(name):
 def list_pdfs_in_folder(folder_id):
     files = query_drive_files(
         query=f"'{folder_id}' in parents and mimeType = 'application/pdf' and trashed = false",
-        fields="files(id, name, size, createdTime, modifiedTime, parents)"
+        fields="files(id, name, size, createdTime, modifiedTime, md5Checksum, parents)"
     )
 
     # Populate extra metadata we will need
@@ -382,13 +778,39 @@ def list_pdfs_in_folder(folder_id):
         file['src_name'] = file['name']
         file['dest_name'] = sanitize_file_name(file['name'])
         del file['name']
-        file['filehash'] = java_string_hashcode(file['dest_name'])
+        file['filehash'] = get_filehash(file['dest_name'])
         dt = parser.isoparse(file['modifiedTime'])
         file['modifiedTime'] = int(dt.timestamp() * 1000)
         dt = parser.isoparse(file['createdTime'])
         file['createdTime'] = int(dt.timestamp() * 1000)
     return files
 
+# Listings of source folders already crawled by this process. A batch run shares these between libraries, so source
+# folders that several libraries use are only crawled once. Folder ID to the subfolders in it, or to where its PDF
+# listing starts in CRAWLED_PDFS_PATH (those are written to disk as they come in, so they don't all sit in memory).
+crawled_subfolders = {}
+crawled_pdfs = {}
+CRAWLED_PDFS_PATH = 'cache/crawled_pdfs.jsonl'
+
+# Every library gets its own copy, since songs and files get modified as they're assembled
+def get_crawled_subfolders(folder_id):
+    if folder_id not in crawled_subfolders:
+        crawled_subfolders[folder_id] = list_folders_in_folder(folder_id)
+    return copy.deepcopy(crawled_subfolders[folder_id])
+
+def get_crawled_pdfs(folder_id):
+    if folder_id not in crawled_pdfs:
+        files = list_pdfs_in_folder(folder_id)
+        os.makedirs('cache', exist_ok=True)
+        # Start the file over on the first listing, anything in it is from an earlier process
+        with open(CRAWLED_PDFS_PATH, "ab" if crawled_pdfs else "wb") as f:
+            crawled_pdfs[folder_id] = f.tell()
+            f.write((json.dumps(files, ensure_ascii=False) + '\n').encode('utf-8'))
+        return files
+    with open(CRAWLED_PDFS_PATH, "rb") as f:
+        f.seek(crawled_pdfs[folder_id])
+        return json.loads(f.readline())
+
 # Shorter query to tell if a folder contains any PDFs
 def folder_contains_pdfs(folder_id):
     query = f"'{folder_id}' in parents and mimeType = 'application/pdf' and trashed = false"
@@ -402,14 +824,20 @@ def folder_contains_pdfs(folder_id):
     
     return len(results.get("files", [])) > 0
 
-# Queries a list of top-level folders and assmebles
+# Drops the folders named in Ignore_Folders from a list of top level folders
+def without_ignored_folders(folders):
+    return [folder for folder in folders if folder['name'] not in IGNORE_FOLDERS]
+
+# Queries a list of top-level folders and assmebles songs from their subfolders.
+# Yields one song at a time, in name order, so they can be written out as they're listed. Folders without PDFs and
+# folders with the same name as an earlier one are skipped.
 def query_tree(root_ids):
     # Get top level folders
     top_level_folders = []
     for root_id in root_ids:
-        top_level_folders += list_folders_in_folder(root_id)
+        top_level_folders += get_crawled_subfolders(root_id)
     top_level_folders.sort(key=lambda folder: folder['name'])
-    top_level_folders = [folder for folder in top_level_folders if folder['name'] not in IGNORE_FOLDERS]
+    top_level_folders = without_ignored_folders(top_level_folders)
 
     # Get subfolders
     folders = []
@@ -418,7 +846,7 @@ def query_tree(root_ids):
     with Live(log_indent + "Querying...", console=console, refresh_per_second=4) as live:
         for folder in top_level_folders:
             print("Querying folder [green]" + folder['name'], live=live)
-            folders += list_folders_in_folder(folder['id'])
+            folders += get_crawled_subfolders(folder['id'])
             i+=1
             if i >= MAX_SONGS:
                 break
@@ -427,28 +855,31 @@ def query_tree(root_ids):
     # Get PDFs
     folders.sort(key=lambda folder: folder['name'])
     i = 0
+    file_count = 0
+    seen_names = set()
     push_log_section("Assembling songs from source folders...")
     with Live(log_indent + "Assembling songs...", console=console, refresh_per_second=4) as live:
         for folder in folders:
             print("Assembling song [green]" + folder['name'], live=live)
-            folder['files'] = list_pdfs_in_folder(folder['id'])
+            files = get_crawled_pdfs(folder['id'])
+            file_count += len(files)
+            if files and folder['name'] not in seen_names:
+                seen_names.add(folder['name'])
+                yield dict(folder, files=files)
             i += 1
             if i >= MAX_SONGS:
                 break
-        print(f"Finished assembling [cyan]{len(folders)}[/cyan] songs including [cyan]{sum([len(folder['files']) for folder in folders])}[/cyan] files!", live=live)
+        print(f"Finished assembling [cyan]{i}[/cyan] songs including [cyan]{file_count}[/cyan] files!", live=live)
     pop_log_section()
-    
-    folders = [folder for folder in folders if 'files' in folder and len(folder['files']) > 0]
-
-    return folders
 
 # Finds setlists in a list of docs, and merges any missing songs into the song list
 def query_setlist_docs(setlist_docs, songs):
     setlists = []
+    known_folders = {song['id']: song_idx for song_idx, song in enumerate(songs)}
     for setlist_name in setlist_docs:
         push_log_section("Querying for setlist songs from doc '[cyan]" + setlist_name + "[/cyan]'")
         setlist_doc_id = setlist_docs[setlist_name]
-        setlist_songs = scrape_song_list(setlist_doc_id)
+        setlist_songs = scrape_song_list(setlist_doc_id, songs, known_folders)
         # An index into the song list
         setlist_index = insert_setlist_songs_into_songlist(setlist_songs, songs)
         # Assemble setlist by name
@@ -476,13 +907,31 @@ def find_partless_files(songs):
 def filename_contains(file_name, test_string):
     return test_string.lower().replace(' ', '_') in file_name.lower().replace(' ', '_').replace('.','')
 
+# Which instruments a file is directly for, and which backup/soloist names it matches, as bitmasks
+def classify_file(file):
+    parts = extract_parts_from_filename(file['src_name'])
+    part_mask = 0
+    for part in parts:
+        part_mask |= INSTRUMENT_BITS[part]
+    file_name_sanitized = file['src_name'].lower().replace(' ', '_').replace('.','')
+    label_mask = 0
+    for pattern, bit in LABEL_PATTERNS:
+        if pattern in file_name_sanitized:
+            label_mask |= bit
+    return parts, part_mask, label_mask
+
 # Figure out instrumentation from song titles and which files belong to which instrument
+# Classifies every file once, then fills in backups and soloist parts from the song's coverage masks.
+# Leaves the masks in song['coverage'] for build_coverage().
 def assemble_song_parts(song):
     files = song['files']
     song['parts'] = {}
-    for file in files:
-        file_name = file['src_name']
-        parts = extract_parts_from_filename(file_name)
+    classified = [classify_file(file) for file in files]
+    direct_mask = 0
+    label_mask = 0
+    for file, (parts, file_part_mask, file_label_mask) in zip(files, classified):
+        direct_mask |= file_part_mask
+        label_mask |= file_label_mask
         for part in parts:
             if part not in song['parts']:
                 song['parts'][part] = []
@@ -490,46 +939,93 @@ def assemble_song_parts(song):
             print("[magenta]" + part + "[/magenta]: [green]" + file['src_name'])
     
     # If a part doesn't have a file, try a backup
+    backup_mask = 0
     for part_key in INSTRUMENTS:
-        if part_key not in song['parts']:
-            found = False
-            for backup_part in BACKUP_INSTRUMENTS[part_key]:
-                # Directly take the part if it's in there
-                if backup_part in song['parts']:
-                    song['parts'][part_key] = [file for file in song['parts'][backup_part]]
-                    print("[magenta]" + part_key + "[/magenta] copying backup instrument [green]" + str([file['src_name'] for file in song['parts'][backup_part]]))
-                    break
-                else:
-                    # The backup part might be something werid like "Bb Treble Clef Instruments", so do another filename test
-                    for file in files:
-                        if filename_contains(file['src_name'], backup_part):
-                            song['parts'][part_key] = [file]
-                            print("[magenta]" + part_key + "[/magenta] using backup part [green]" + file['src_name'])
-                            found = True
-                    if found:
-                        break
-            if part_key not in song['parts'] and part_key not in ['Flute', 'Percussion', 'Score']:
-                warn("No part file found for instrument [magenta]" + part_key + "[/magenta] for song [green]" + song['name'])
+        if direct_mask & INSTRUMENT_BITS[part_key]:
+            continue
+        for backup_part in BACKUP_INSTRUMENTS[part_key]:
+            # Directly take the part if it's in there (which includes backups filled in earlier in this loop)
+            if backup_part in song['parts']:
+                song['parts'][part_key] = [file for file in song['parts'][backup_part]]
+                print("[magenta]" + part_key + "[/magenta] copying backup instrument [green]" + str([file['src_name'] for file in song['parts'][backup_part]]))
+                break
+            # The backup part might be something werid like "Bb Treble Clef Instruments", so check the file name matches
+            elif label_mask & LABEL_BITS[backup_part]:
+                for file, (parts, file_part_mask, file_label_mask) in zip(files, classified):
+                    if file_label_mask & LABEL_BITS[backup_part]:
+                        song['parts'][part_key] = [file]
+                        print("[magenta]" + part_key + "[/magenta] using backup part [green]" + file['src_name'])
+                break
+        if part_key in song['parts']:
+            backup_mask |= INSTRUMENT_BITS[part_key]
+        elif part_key not in OPTIONAL_PARTS:
+            warn("No part file found for instrument [magenta]" + part_key + "[/magenta] for song [green]" + song['name'])
 
     # Solo parts
+    solo_mask = 0
     for part_key in INSTRUMENTS: # Tenor Sax, etc
-        for file in files: # file['src_name'] = "Soloist (Bb) - Valerie.pdf", etc
+        if not label_mask & SOLO_LABEL_MASKS[part_key]:
+            continue
+        solo_mask |= INSTRUMENT_BITS[part_key]
+        for file, (parts, file_part_mask, file_label_mask) in zip(files, classified): # file['src_name'] = "Soloist (Bb) - Valerie.pdf", etc
             for solo_part in SOLO_PARTS[part_key]: # Soloist (Bb), etc
-                if filename_contains(file['src_name'], solo_part):
+                if file_label_mask & LABEL_BITS[solo_part]:
                     print("[magenta]" + part_key + "[/magenta] using soloist part [green]" + file['src_name'])
                     if part_key not in song['parts']:
                         song['parts'][part_key] = []
                     song['parts'][part_key].append(file)
-                    
+
+    assigned = set(id(file) for part_key in song['parts'] for file in song['parts'][part_key])
     for file in song['files']:
-        found = False
-        for part_key in song['parts']:
-            if file in song['parts'][part_key]:
-                found = True
-                break
-        if not found:
+        if id(file) not in assigned:
             print("[yellow]Instrument not found for file: " + file['src_name'])
 
+    song['coverage'] = {'direct': direct_mask, 'backup': backup_mask, 'solo': solo_mask}
+
+# Library-wide coverage matrix, built from the masks assemble_song_parts left behind.
+# rows[i] is the mask of instruments song i has a part for, columns[part] is the mask of songs that part covers.
+def build_coverage(songs):
+    coverage = {'rows': [], 'columns': {part: 0 for part in INSTRUMENTS}, 'direct': [], 'backup': [], 'solo': []}
+    for song_idx, song in enumerate(songs):
+        row = 0
+        for part in song['parts']:
+            row |= INSTRUMENT_BITS[part]
+        song_coverage = song.get('coverage', {})
+        coverage['rows'].append(row)
+        coverage['direct'].append(song_coverage.get('direct', row))
+        coverage['backup'].append(song_coverage.get('backup', 0))
+        coverage['solo'].append(song_coverage.get('solo', 0))
+    for part in INSTRUMENTS:
+        bit = INSTRUMENT_BITS[part]
+        column = 0
+        for song_idx, row in enumerate(coverage['rows']):
+            if row & bit:
+                column |= 1 << song_idx
+        coverage['columns'][part] = column
+    return coverage
+
+def parts_in_mask(mask):
+    return [part for part in INSTRUMENTS if mask & INSTRUMENT_BITS[part]]
+
+# Writes the whole catalog's coverage as a spreadsheet, one row per song and one column per instrument
+def export_coverage(songs, coverage, path):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Song"] + list(INSTRUMENTS) + ["Missing"])
+        for song_idx, song in enumerate(songs):
+            cells = []
+            for part in INSTRUMENTS:
+                bit = INSTRUMENT_BITS[part]
+                if coverage['direct'][song_idx] & bit:
+                    cells.append("part")
+                elif coverage['backup'][song_idx] & bit:
+                    cells.append("backup")
+                elif coverage['solo'][song_idx] & bit:
+                    cells.append("solo only")
+                else:
+                    cells.append("")
+            missing = REQUIRED_PARTS_MASK & ~coverage['rows'][song_idx]
+            writer.writerow([song['name']] + cells + [", ".join(parts_in_mask(missing))])
 
 # Function for getting a sanitized instrument/part name out of "MySong123 - __Tenor__123_v4"
 def extract_parts_from_filename(file_name):
@@ -557,9 +1053,24 @@ def extract_folder_id(url):
     match = re.search(r"/folders/([a-zA-Z0-9_-]+)", url)
     return match.group(1) if match else None
 
-# Scrapes a doc (like the Weekly Agenda) and extracts all songs linked
-def scrape_song_list(doc_id):
-    doc = docs.documents().get(documentId=doc_id).execute()
+# Only the link URLs are needed from the agenda doc, so don't pull down the whole body
+DOC_LINK_FIELDS = "revisionId,body(content(paragraph(elements(textRun(textStyle(link(url)))))))"
+AGENDA_CACHE_PATH = 'cache/agendas.json'
+
+# Cheap check for whether a doc has been edited
+def get_doc_revision(doc_id):
+    return docs.documents().get(documentId=doc_id, fields="revisionId").execute().get('revisionId')
+
+# Gets the Drive folder links in a doc, reusing the links from last time if the doc has not been edited
+def get_doc_folder_links(doc_id):
+    agenda_cache = load_dict(AGENDA_CACHE_PATH) or {}
+    revision_id = get_doc_revision(doc_id)
+    cached = agenda_cache.get(doc_id)
+    if revision_id and cached and cached['revisionId'] == revision_id:
+        print('Doc unchanged since last run (revision [cyan]' + revision_id + '[/cyan]), reusing links')
+        return cached['links']
+
+    doc = docs.documents().get(documentId=doc_id, fields=DOC_LINK_FIELDS).execute()
     content = doc["body"]["content"]
 
     links = []
@@ -575,20 +1086,38 @@ def scrape_song_list(doc_id):
 
     links = [link for link in links if bool(re.match(r"^https://drive\.google\.com/drive/.*folders/.*", link))]
 
-    songs = []
+    if doc.get('revisionId'):
+        agenda_cache[doc_id] = {'revisionId': doc['revisionId'], 'links': links}
+        os.makedirs('cache', exist_ok=True)
+        save_dict(AGENDA_CACHE_PATH, agenda_cache)
+    return links
+
+# Scrapes a doc (like the Weekly Agenda) and extracts all songs linked
+# known_folders is a dict of folder ID to the index of an already-crawled song in songs, so we only query the Drive for
+# folders outside of it
+def scrape_song_list(doc_id, songs, known_folders):
+    links = get_doc_folder_links(doc_id)
+
+    setlist_songs = []
     # Get files at Drive links
     for link in links:
         folder_id = extract_folder_id(link)
-        folder_name = get_folder_name(folder_id)
-        folder = {'id': folder_id, 'name': folder_name, 'files': list_pdfs_in_folder(folder_id)}
+        if folder_id in known_folders:
+            folder = songs[known_folders[folder_id]]
+            if args.verbose:
+                print('Using already queried folder for [green]' + folder['name'])
+        else:
+            folder_name = get_folder_name(folder_id)
+            # Not cached like the library crawl, since agenda folders are often still being filled in when they're linked
+            folder = {'id': folder_id, 'name': folder_name, 'files': list_pdfs_in_folder(folder_id)}
         
         if len(folder['files']) > 0:
-            print('Found folder in doc: [green]' + folder_name)
-            songs.append(folder)
+            print('Found folder in doc: [green]' + folder['name'])
+            setlist_songs.append(folder)
         else:
-            print('Found folder in doc: [green]' + folder_name + '[/green] (skipping, no PDFs found)')
+            print('Found folder in doc: [green]' + folder['name'] + '[/green] (skipping, no PDFs found)')
     
-    return songs
+    return setlist_songs
 
 def list_subfolders(parent_folder_id):
     return query_drive_files(
@@ -638,7 +1167,15 @@ def escape_drive_query(name):
     # escape single quotes by doubling them
     return name.replace("'", "\\'")
 
-# Drive copy file if newer
+# True if two Drive files have the same bytes, going by md5Checksum and size
+def same_file_content(a, b):
+    if not a.get('md5Checksum') or not b.get('md5Checksum'):
+        return False
+    return a['md5Checksum'] == b['md5Checksum'] and a.get('size') == b.get('size')
+
+# Drive copy file if its content changed
+# modifiedTime is only a quick pre-filter. A newer source with the same md5Checksum/size (metadata touch, re-upload
+# of the same PDF) leaves the destination alone, since every copy gets a new ID that every tablet has to re-download.
 def sync_file(source_file, dest_folder, existing_file=None, live=None):
     # Get source file metadata
     source_name = source_file["src_name"]
@@ -648,8 +1185,12 @@ def sync_file(source_file, dest_folder, existing_file=None, live=None):
     if existing_file:
         existing_modified = existing_file["modifiedTime"]
 
-        # Compare modified timestamps
-        if source_modified > existing_modified:
+        # Compare modified timestamps, then content
+        if source_modified > existing_modified and same_file_content(source_file, existing_file):
+            if args.verbose:
+                print(f"Source file '{source_name}' is newer but has identical content. Skipping copy.", live=live)
+            return existing_file["id"]
+        elif source_modified > existing_modified:
             print(f"Source file is newer. Replacing '{source_name}'", live=live)
             # Delete the old copy
             # Don't use delete() anymore since that is a permanent operation and requires Drive membership
@@ -677,33 +1218,105 @@ def get_file_metadata(file_id):
         supportsAllDrives=True
     ).execute()
 
-# De-dupe files... for debugging when things get messed up
-def dedupe_files(folder):
-    seen = set()
-    for file in folder['files']:
-        if file['dest_name'] not in seen:
-            seen.add(file['dest_name'])
-        else:
-            print(f"De-duping '[green]{file['dest_name']}[/green]' with ID {file['id']} in folder '[magenta]{folder['dest_name']}'[/magenta]")
-            drive.files().update(
-                fileId=file["id"],
-                body={"trashed": True},
-                supportsAllDrives=True
-            ).execute()
+# The Drive API allows up to 100 calls in one batch request
+DRIVE_BATCH_SIZE = 100
+
+# Moves files to the trash, batching the requests. Returns how many were trashed.
+def trash_files_in_bulk(file_ids):
+    failures = []
+    def callback(request_id, response, exception):
+        if exception:
+            failures.append((request_id, exception))
+    for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+        batch = drive.new_batch_http_request(callback=callback)
+        for file_id in file_ids[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(drive.files().update(fileId=file_id, body={"trashed": True}, supportsAllDrives=True), request_id=file_id)
+        batch.execute()
+    for file_id, exception in failures:
+        error(f"Could not trash file {file_id}: {exception}")
+    return len(file_ids) - len(failures)
+
+# Finds garbage in the part folders, compared to what the current part assignments say should be there:
+#   orphans: PDFs that no song's part points at any more (the source was deleted or renamed)
+#   duplicates: extra files with the same name in one folder, the newest one is kept
+# Shows a summary, asks, then trashes them all in bulk.
+def collect_part_folder_garbage(songs, part_folders, orphans=True):
+    expected = {part: set() for part in part_folders}
+    for song in songs:
+        for part in song['parts']:
+            for file in song['parts'][part]:
+                expected[part].add(content_source(file)['dest_name'])
+
+    garbage = [] # (part, dest file, reason)
+    for part in part_folders:
+        folder = part_folders[part]
+        folder['files'] = list_pdfs_in_folder(folder['id'])
+        by_name = {}
+        for dest_file in folder['files']:
+            by_name.setdefault(dest_file['src_name'], []).append(dest_file)
+        for name in by_name:
+            copies = sorted(by_name[name], key=lambda dest_file: dest_file['modifiedTime'], reverse=True)
+            if name not in expected[part]:
+                if orphans:
+                    garbage += [(part, dest_file, 'orphan') for dest_file in copies]
+            else:
+                garbage += [(part, dest_file, 'duplicate') for dest_file in copies[1:]]
+
+    if not garbage:
+        print("Part folders are clean, nothing to trash!")
+        return 0
+
+    # Summary
+    for part in part_folders:
+        part_garbage = [entry for entry in garbage if entry[0] == part]
+        if not part_garbage:
+            continue
+        orphan_count = len([entry for entry in part_garbage if entry[2] == 'orphan'])
+        print(f"[magenta]{part}[/magenta]: [cyan]{orphan_count}[/cyan] orphans, [cyan]{len(part_garbage) - orphan_count}[/cyan] duplicates (of {len(part_folders[part]['files'])} PDFs)")
+        for entry in part_garbage:
+            print(f"    [yellow]{entry[2]}[/yellow] [green]{entry[1]['src_name']}", print_to_std_out=args.verbose)
+        if orphan_count > len(part_folders[part]['files']) / 2:
+            warn(f"More than half of [magenta]{part}[/magenta] looks orphaned, double check the song list before saying yes!")
+    garbage_bytes = sum(int(entry[1].get('size', 0)) for entry in garbage)
+    answer = input(f"Trash {len(garbage)} files ({garbage_bytes / 1024 / 1024:.1f} MB)? [y/N] ")
+    if answer.strip().lower() not in ['y', 'yes']:
+        print("Leaving the part folders alone")
+        return 0
+
+    trashed = trash_files_in_bulk([entry[1]['id'] for entry in garbage])
+    trashed_ids = set(entry[1]['id'] for entry in garbage)
+    for part in part_folders:
+        part_folders[part]['files'] = [dest_file for dest_file in part_folders[part]['files'] if dest_file['id'] not in trashed_ids]
+    print(f"Trashed [cyan]{trashed}[/cyan] files")
+    return trashed
 
 # Make copies of files to my Drive
-def copy_songlist_into_drive(songs, part_folders):
+# If instruments is given, only files for those parts are copied
+def copy_songlist_into_drive(songs, part_folders, instruments=None):
     with Live(log_indent + "Finding files...", console=console, refresh_per_second=10) as inner_live:
         with Live(log_indent + "Copying...", console=console, refresh_per_second=10) as outer_live:
             up_to_date = 0
             new_files = 0
             updated_files = 0
+            duplicate_files = 0
+            handled = set() # (part, source file ID) already copied in this call, so identical PDFs only get copied once
             for song in songs:
                 push_log_section("Copying files for [green]" + song['name'], live=outer_live, save_to_file=args.verbose)
                 for part_key in song['parts']:
+                    if instruments is not None and part_key not in instruments:
+                        continue
                     files = song['parts'][part_key]
                     # Some parts have more than one chart (trumpet 1/2), so copy all files
                     for file in files:
+                        file = content_source(file)
+                        if (part_key, file['id']) in handled:
+                            duplicate_files += 1
+                            continue
+                        handled.add((part_key, file['id']))
+                        if journal_get('copies', part_key + '/' + file['id']) == file['modifiedTime']:
+                            # Already copied earlier in this (interrupted) run
+                            up_to_date += 1
+                            continue
                         needs_copy = True
                         existing_dest_file = None
                         for dest_file in part_folders[part_key]['files']:
@@ -719,6 +1332,7 @@ def copy_songlist_into_drive(songs, part_folders):
                             existing_file=existing_dest_file,
                             live=inner_live,
                         )
+                        journal_record('copies', part_key + '/' + file['id'], file['modifiedTime'])
                         if not existing_dest_file:
                             new_files += 1
                         elif copied == existing_dest_file['id']:
@@ -728,11 +1342,13 @@ def copy_songlist_into_drive(songs, part_folders):
 
                 pop_log_section()
             print(f"Finished copying all songs!", live=outer_live)
-            print(f"[cyan]{new_files}[/cyan] new files. [cyan]{updated_files}[/cyan] changed files. [cyan]{up_to_date}[/cyan] files up to date.", live=inner_live)
+            print(f"[cyan]{new_files}[/cyan] new files. [cyan]{updated_files}[/cyan] changed files. [cyan]{up_to_date}[/cyan] files up to date. [cyan]{duplicate_files}[/cyan] duplicates skipped.", live=inner_live)
 
 
 # Uploads a file, deleting an existing one if it exists.
-def upload_to_drive(local_path, dest_name, parent_folder_id, live=None):
+# Pass a separate service when uploading from a background thread, the API clients aren't thread safe.
+def upload_to_drive(local_path, dest_name, parent_folder_id, live=None, service=None):
+    service = service or drive
     # Look for existing file with this exact name in this exact folder
     query = (
         f"name = '{dest_name}' "
@@ -743,6 +1359,7 @@ def upload_to_drive(local_path, dest_name, parent_folder_id, live=None):
     files = query_drive_files(
         query = query,
         fields = "files(id, name)",
+        service = service,
     )
 
     # Delete existing file(s) with that name
@@ -752,7 +1369,7 @@ def upload_to_drive(local_path, dest_name, parent_folder_id, live=None):
         # I am but a lowly Content Manager, so I will move to trash, which is also much safer
         # and I didn't know existed until Google Drive prevented me from doing it via API
         # drive.files().delete(fileId=f["id"], supportsAllDrives=True).execute()
-        drive.files().update(
+        service.files().update(
             fileId=f["id"],
             body={"trashed": True},
             supportsAllDrives=True
@@ -766,7 +1383,7 @@ def upload_to_drive(local_path, dest_name, parent_folder_id, live=None):
 
     media = MediaFileUpload(local_path, resumable=True)
 
-    uploaded = drive.files().create(
+    uploaded = service.files().create(
         body=file_metadata,
         media_body=media,
         fields="id, name",
@@ -776,10 +1393,18 @@ def upload_to_drive(local_path, dest_name, parent_folder_id, live=None):
     print(f"Uploaded {uploaded['name']} ({uploaded['id']})", live=live)
     return uploaded["id"]
 
-def clear_output_folder(live=None):
-    folder = 'output'
+# If instruments is given, only that instruments' databases and hashcodes are removed
+def clear_output_folder(live=None, instruments=None):
+    folder = library_path('output')
+    os.makedirs(folder, exist_ok=True)
+    keep_names = None
+    if instruments is not None:
+        stems = [instrument.replace(' ','_').lower() for instrument in instruments]
+        keep_names = set(stem + '.db' for stem in stems) | set(stem + '_hashcodes.txt' for stem in stems)
     for name in os.listdir(folder):
         path = os.path.join(folder, name)
+        if keep_names is not None and name not in keep_names:
+            continue
         if os.path.isfile(path):
             os.remove(path)
             if args.verbose:
@@ -787,7 +1412,7 @@ def clear_output_folder(live=None):
 
 # Create a .db file from a template, removing the old one if it exists.
 def create_database(db_name, live=None):
-    db_path = 'output/' + db_name.replace(' ','_').lower() + '.db'
+    db_path = library_path('output/' + db_name.replace(' ','_').lower() + '.db')
     if os.path.exists(db_path):
         print('Removing old ' + db_path + ' and replacing with a blank fresh library db', live=live)
         os.remove(db_path)
@@ -795,6 +1420,41 @@ def create_database(db_name, live=None):
         print('Created ' + db_path, live=live)
     shutil.copy("ltbb_blank.db", db_path)
 
+# Candidate SQLite page sizes for the output databases. The template has ~60 mostly-empty tables and
+# each table/index takes at least one page, so small pages usually win, but big libraries might not.
+DB_PAGE_SIZES = [512, 1024, 2048, 4096]
+
+# Shrink a finished .db file as much as the schema allows, since every tablet downloads the whole thing.
+# Tries each candidate page size with ANALYZE + VACUUM and keeps whichever file comes out smallest.
+def optimize_database(db_path, live=None):
+    original_size = os.path.getsize(db_path)
+    best_path = None
+    best_size = original_size
+    for page_size in DB_PAGE_SIZES:
+        candidate_path = db_path + '.' + str(page_size)
+        shutil.copy(db_path, candidate_path)
+        conn = sqlite3.connect(candidate_path)
+        # page_size only takes effect on the next VACUUM, and only outside of WAL mode
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.execute(f"PRAGMA page_size = {page_size}")
+        conn.execute("ANALYZE")
+        conn.execute("VACUUM")
+        conn.close()
+        candidate_size = os.path.getsize(candidate_path)
+        if args.verbose:
+            print(f"Page size [cyan]{page_size}[/cyan] gives [cyan]{candidate_size // 1024}[/cyan] KB for {db_path}", live=live)
+        if candidate_size < best_size:
+            if best_path:
+                os.remove(best_path)
+            best_path = candidate_path
+            best_size = candidate_size
+        else:
+            os.remove(candidate_path)
+    if best_path:
+        os.replace(best_path, db_path)
+    print(f"Optimized [cyan]{db_path}[/cyan]: [cyan]{original_size // 1024}[/cyan] KB -> [cyan]{best_size // 1024}[/cyan] KB", live=live)
+    return best_size
+
 # Hashcode function, kind of close to the function that MobileSheets uses,
 # but I think we're okay if we don't have exactly the same one. We'll find out I guess.
 def java_string_hashcode(s: str) -> int:
@@ -805,51 +1465,258 @@ def java_string_hashcode(s: str) -> int:
         h = -((~h + 1) & 0xFFFFFFFF)
     return h
 
+# java_string_hashcode() of every file name seen by this process. The same names come up again on every crawl,
+# in every part folder listing and in every library of a batch run, so each one only gets hashed once.
+# They're saved to FILEHASHES_PATH, so the next run can reuse the hashes of names that are still around.
+FILEHASHES_PATH = 'cache/filehashes.json'
+filehashes = {}
+saved_filehashes = None
+def get_filehash(name):
+    global saved_filehashes
+    filehash = filehashes.get(name)
+    if filehash is None:
+        if saved_filehashes is None:
+            saved_filehashes = load_dict(FILEHASHES_PATH) or {}
+        filehash = saved_filehashes.get(name)
+        if filehash is None:
+            filehash = java_string_hashcode(name)
+        filehashes[name] = filehash
+    return filehash
+
+# Only the names used by this run are kept, so renamed and deleted files drop out
+def save_filehashes():
+    if filehashes:
+        os.makedirs('cache', exist_ok=True)
+        save_dict(FILEHASHES_PATH, filehashes)
+
+# Regexes for the few bits of PDF structure we need to count pages without PyPDF2
+PDF_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+PDF_ROOT_RE = re.compile(rb"/Root\s+(\d+)\s+(\d+)\s+R")
+PDF_PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+PDF_PAGES_RE = re.compile(rb"/Pages\s+(\d+)\s+(\d+)\s+R")
+# The \b stops the lookahead from being dodged by backtracking, e.g. reading "/Count 12 0 R" as a count of 1
+PDF_COUNT_RE = re.compile(rb"/Count\s+(\d+)\b(?!\s+\d+\s+R)")
+PDF_COUNT_REF_RE = re.compile(rb"/Count\s+(\d+)\s+\d+\s+R")
+PDF_INTEGER_RE = re.compile(rb"\d+\s+\d+\s+obj\s*(\d+)\s*$")
+PDF_STREAM_RE = re.compile(rb">>\s*stream\r?\n")
+PDF_W_RE = re.compile(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]")
+PDF_INDEX_RE = re.compile(rb"/Index\s*\[([\d\s]+)\]")
+PDF_SIZE_RE = re.compile(rb"/Size\s+(\d+)")
+PDF_FIRST_RE = re.compile(rb"/First\s+(\d+)")
+PDF_N_RE = re.compile(rb"/N\s+(\d+)")
+PDF_PREDICTOR_RE = re.compile(rb"/Predictor\s+(\d+)")
+PDF_COLUMNS_RE = re.compile(rb"/Columns\s+(\d+)")
+
+# Reads the dictionary and decoded contents of the stream object starting at offset
+def read_pdf_stream(data, offset):
+    match = PDF_STREAM_RE.search(data, offset)
+    if not match:
+        raise ValueError("No stream found at offset " + str(offset))
+    header = data[offset:match.start()]
+    stream = data[match.end():data.find(b"endstream", match.end())]
+    if b"/Filter" in header:
+        if b"/FlateDecode" not in header or b"[" in header[header.index(b"/Filter"):][:12]:
+            raise ValueError("Unsupported stream filter")
+        stream = zlib.decompressobj().decompress(stream)
+    predictor = PDF_PREDICTOR_RE.search(header)
+    if predictor and int(predictor.group(1)) >= 10:
+        # PNG predictors: every row starts with a filter type byte
+        columns = PDF_COLUMNS_RE.search(header)
+        columns = int(columns.group(1)) if columns else 1
+        rows = []
+        previous = bytes(columns)
+        for i in range(0, len(stream), columns + 1):
+            filter_type = stream[i]
+            row = bytearray(stream[i + 1:i + 1 + columns])
+            if filter_type == 1:
+                for k in range(1, len(row)):
+                    row[k] = (row[k] + row[k - 1]) & 0xFF
+            elif filter_type == 2:
+                for k in range(len(row)):
+                    row[k] = (row[k] + previous[k]) & 0xFF
+            elif filter_type != 0:
+                raise ValueError("Unsupported PNG predictor " + str(filter_type))
+            rows.append(bytes(row))
+            previous = row
+        stream = b"".join(rows)
+    return header, stream
+
+# Reads the cross-reference sections (following /Prev for incremental updates) into a dict of object number to
+# either ('n', byte offset) or ('c', object stream number, index in object stream).
+# Also returns the /Root reference from the newest trailer.
+def read_pdf_xref(data):
+    startxrefs = list(PDF_STARTXREF_RE.finditer(data, max(0, len(data) - 2048)))
+    if not startxrefs:
+        return {}, None
+    offset = int(startxrefs[-1].group(1))
+    entries = {}
+    root = None
+    seen = set()
+    while offset is not None and offset not in seen and offset < len(data):
+        seen.add(offset)
+        if data[offset:offset + 4] == b"xref":
+            # Classic xref table followed by a trailer dictionary
+            trailer_pos = data.find(b"trailer", offset)
+            if trailer_pos < 0:
+                break
+            tokens = data[offset + 4:trailer_pos].split()
+            i = 0
+            while i + 1 < len(tokens):
+                start, count = int(tokens[i]), int(tokens[i + 1])
+                i += 2
+                for k in range(count):
+                    # Newer sections come first, so keep the first entry we see for each object
+                    if tokens[i + 2] == b"n" and start + k not in entries:
+                        entries[start + k] = ('n', int(tokens[i]))
+                    i += 3
+            trailer = data[trailer_pos:data.find(b"startxref", trailer_pos)]
+        else:
+            # Cross-reference stream (PDF 1.5+)
+            trailer, stream = read_pdf_stream(data, offset)
+            widths = [int(w) for w in PDF_W_RE.search(trailer).groups()]
+            index = PDF_INDEX_RE.search(trailer)
+            if index:
+                index = [int(n) for n in index.group(1).split()]
+            else:
+                index = [0, int(PDF_SIZE_RE.search(trailer).group(1))]
+            pos = 0
+            for start, count in zip(index[0::2], index[1::2]):
+                for k in range(count):
+                    fields = []
+                    for width in widths:
+                        fields.append(int.from_bytes(stream[pos:pos + width], 'big'))
+                        pos += width
+                    # A zero-width type field means type 1
+                    entry_type = fields[0] if widths[0] else 1
+                    if start + k in entries:
+                        continue
+                    if entry_type == 1:
+                        entries[start + k] = ('n', fields[1])
+                    elif entry_type == 2:
+                        entries[start + k] = ('c', fields[1], fields[2])
+        if root is None:
+            match = PDF_ROOT_RE.search(trailer)
+            root = (int(match.group(1)), int(match.group(2))) if match else None
+        match = PDF_PREV_RE.search(trailer)
+        offset = int(match.group(1)) if match else None
+    return entries, root
+
+# Returns the bytes of an indirect object, or None if the xref doesn't know about it
+def find_pdf_object(data, xref_entries, obj_num):
+    entry = xref_entries.get(obj_num)
+    if entry is None:
+        return None
+    if entry[0] == 'n':
+        end = data.find(b"endobj", entry[1])
+        return data[entry[1]:end] if end >= 0 else None
+    # The object is compressed inside an object stream
+    stream_entry = xref_entries.get(entry[1])
+    if stream_entry is None or stream_entry[0] != 'n':
+        return None
+    header, stream = read_pdf_stream(data, stream_entry[1])
+    first = int(PDF_FIRST_RE.search(header).group(1))
+    count = int(PDF_N_RE.search(header).group(1))
+    offsets = [int(n) for n in stream[:first].split()[1:2 * count:2]]
+    if entry[2] >= len(offsets):
+        return None
+    end = offsets[entry[2] + 1] if entry[2] + 1 < len(offsets) else len(stream) - first
+    return stream[first + offsets[entry[2]]:first + end]
+
+# Memory-maps a PDF and reads the page count straight out of the root /Pages node, without building the whole object tree.
+# Returns None if the file is laid out in a way this doesn't understand.
+def fast_page_count(path):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            xref_entries, root = read_pdf_xref(data)
+            if root is None:
+                return None
+            catalog = find_pdf_object(data, xref_entries, root[0])
+            if catalog is None:
+                return None
+            match = PDF_PAGES_RE.search(catalog)
+            if not match:
+                return None
+            pages = find_pdf_object(data, xref_entries, int(match.group(1)))
+            if pages is None or b"/Pages" not in pages:
+                return None
+            match = PDF_COUNT_RE.search(pages)
+            if match:
+                return int(match.group(1))
+            # The count can also be an indirect reference to an integer object
+            match = PDF_COUNT_REF_RE.search(pages)
+            if not match:
+                return None
+            count_object = find_pdf_object(data, xref_entries, int(match.group(1)))
+            if count_object is None:
+                return None
+            match = PDF_INTEGER_RE.search(count_object.strip()) or re.fullmatch(rb"\s*(\d+)\s*", count_object)
+            return int(match.group(1)) if match else None
+
 # PDF page counter
+# Tries the fast mmap reader first and only builds a full PyPDF2 reader if that fails
 def get_page_count(path):
+    try:
+        page_count = fast_page_count(path)
+    except Exception:
+        # Anything unusual about the file, let PyPDF2 deal with it
+        page_count = None
+    if page_count:
+        return page_count
     reader = PdfReader(path)
     return len(reader.pages)
 
+# Don't bother spinning up worker processes for just a handful of files
+PAGE_COUNT_POOL_MIN = 8
+
+# Counts pages for a list of local PDF paths, across a process pool if there are enough of them.
+# Yields (path, page count) as they finish, so progress can be saved along the way.
+def count_pages(paths):
+    if len(paths) < PAGE_COUNT_POOL_MIN:
+        for path in paths:
+            yield path, get_page_count(path)
+        return
+    with ProcessPoolExecutor() as pool:
+        yield from zip(paths, pool.map(get_page_count, paths, chunksize=4))
+
 # File download
 def download_pdf_for_pagecount(file, dest_path):
     # Download the file to get the page count
+    # Download to a temp file first so an interrupted download never looks like a cached PDF
     request = drive.files().get_media(fileId=file['id'], supportsAllDrives=True)
-    with io.FileIO(dest_path, 'wb') as fh:
+    tmp_path = dest_path + '.part'
+    with io.FileIO(tmp_path, 'wb') as fh:
         downloader = MediaIoBaseDownload(fh, request)
         done = False
         while not done:
             status, done = downloader.next_chunk()
-
-# Removes duplicates by 'name'
-# Keeps the first, removes those at the end
-def remove_duplicate_dicts(data):
-    seen = set()
-    to_remove = []
-    for i in range(len(data)):
-        if data[i]["name"] in seen:
-            to_remove.append(i)
-        else:
-            seen.add(data[i]["name"])
-    for i in reversed(to_remove):
-        del data[i]
+    os.replace(tmp_path, dest_path)
 
 def insert_setlist_songs_into_songlist(setlist_songs, songs):
+    # First song with each name, looked up once instead of scanning the song list for every setlist song
+    song_indices = {}
+    for i, song in enumerate(songs):
+        song_indices.setdefault(song['name'], i)
     setlist_index = []
     for setlist_song in setlist_songs:
-        found = False
-        for i in range(len(songs)):
-            if songs[i]['name'] == setlist_song['name']:
-                songs[i] = setlist_song
-                found = True
-                # print("Inserting setlist index found " + i)
-                setlist_index.append(i)
-                break
-        if not found:
+        if setlist_song['name'] in song_indices:
+            i = song_indices[setlist_song['name']]
+            songs[i] = setlist_song
+            # print("Inserting setlist index found " + i)
+            setlist_index.append(i)
+        else:
             songs.append(setlist_song)
+            song_indices[setlist_song['name']] = len(songs)-1
             setlist_index.append(len(songs)-1)
             # print("Inserting setlist index found " + i)
     return setlist_index
 
+PAGE_COUNT_CACHE_PATH = 'cache/pagecounts.json'
+
+# Where a Drive PDF gets cached locally for page counting
+def get_pdf_cache_path(file):
+    file_name_sanitized = file['src_name'].replace(' ', '_').replace('\\', '_').replace('/','_').replace('?','')
+    return "cache/pdf/" + file_name_sanitized
+
 # Check to see if we have a local copy of the file, or if that file is out of date
 def needs_download(local_dir, filename, gd_modified_ms):
     local_dir = pathlib.Path(local_dir)
@@ -868,25 +1735,286 @@ def needs_download(local_dir, filename, gd_modified_ms):
     # If Google Drive version is newer, download
     return gd_ts > local_ts
 
+# Songs per batch of inserts for each instrument, so only that many songs' rows are ever waiting to go into SQLite
+ROW_BATCH_SIZE = 100
+
+# Inserts the Songs/Files/per-page rows for a batch of one instrument's (song_id, file, source). source is the file
+# whose copy is in the part folder, since identical PDFs share one copy.
+# Row IDs are all derived from the SongId, so the same song gets the same rows in every run and MobileSheets sync has
+# less to reconcile.
+def insert_song_rows(cur, part_folder_id, part_files):
+    # The file names are ugly. We can change the name in the MobileSheets database without changing the file name.
+    cur.executemany("""
+    INSERT INTO Songs (Id, Title, Difficulty, LastPage, OrientationLock, Duration, Stars, VerticalZoom, Sharpen, SharpenLevel, CreationDate, LastModified, Keywords, AutoStartAudio, SongId)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id, file['preferred_name'], 0, 0, 0, 0, 0, 1.0, 0, 7, file['createdTime'], file['modifiedTime'], "", 0, 0) for song_id, file, source in part_files))
+
+    cur.executemany("""
+    INSERT INTO Files (Id, SongId, Path, PageOrder, FileSize, LastModified, Source, Type, SourceFilePageCount, FileHash, Width, Height)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id, song_id, part_folder_id + '/' + source['dest_name'], file['pageorder'], source['size'], source.get('publishedTime', source['modifiedTime']), 1, 1, file['pagecount'], source['filehash'], -1, -1) for song_id, file, source in part_files))
+
+    cur.executemany("""
+    INSERT INTO AutoScroll (Id, SongId, Behavior, PauseDuration, Speed, FixedDuration, ScrollPercent, ScrollOnLoad, TimeBeforeScroll)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id, song_id, 0, 8000, 3, 1000, 20, 0, 2000) for song_id, file, source in part_files))
+
+    cur.executemany("""
+    INSERT INTO Crop (Id, SongId, Page, Left, Top, Right, Bottom, Rotation)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id * PAGE_ID_STRIDE + i, song_id, i, 0, 0, 0, 0, 0) for song_id, file, source in part_files for i in range(file['pagecount'])))
+
+    cur.executemany("""
+    INSERT INTO ZoomPerPage (Id, SongId, Page, Zoom, PortPanX, PortPanY, LandZoom, LandPanX, LandPanY, FirstHalfY, SecondHalfY)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id * PAGE_ID_STRIDE + i, song_id, i, 100.0, 0, 0, 100.0, 0, 0, 0, 0) for song_id, file, source in part_files for i in range(file['pagecount'])))
+
+    cur.executemany("""
+    INSERT INTO MetronomeSettings (Id, SongId, Sig1, Sig2, Subdivision, SoundFX, AccentFirst, AutoStart, CountIn, NumberCount, AutoTurn)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    ((song_id, song_id, 2, 0, 0, 0, 0, 0, 0, 1, 0) for song_id, file, source in part_files))
+
+    cur.executemany("""
+    INSERT INTO MetronomeBeatsPerPage (Id, SongId, Page, BeatsPerPage)
+    VALUES (?, ?, ?, ?)""",
+    ((song_id * PAGE_ID_STRIDE + i, song_id, i, 0) for song_id, file, source in part_files for i in range(file['pagecount'])))
+
+# Inserts the Songs/Files/per-page/setlist rows for several instruments into their open databases, and writes their
+# hashcodes manifests, in a single pass over the songs. Only one song is read at a time, and rows go into SQLite in
+# batches of ROW_BATCH_SIZE songs.
+# cursors is a dict of instrument to database cursor, manifest_files a dict of instrument to an open hashcodes file.
+# song_id_map is a dict of Drive file ID to SongId from assign_song_ids(). song_indices limits which songs get rows
+# (setlist songs always do). With replace, rows already in the databases for those songs are deleted first.
+# Returns a dict of instrument to the number of songs added.
+def insert_library_rows(cursors, manifest_files, songs, setlists, part_folders, song_id_map, live=None, song_indices=None, replace=False):
+    if song_indices is None:
+        song_indices = range(len(songs))
+    batches = {part: [] for part in cursors}
+    # SongIds of the files with rows (a file can be listed twice, e.g. also as a soloist part) and of the source files
+    # already in the manifest
+    inserted = {part: set() for part in cursors}
+    hashed = {part: set() for part in cursors}
+    song_counts = {part: 0 for part in cursors}
+
+    def flush_batch(part):
+        if replace:
+            delete_song_rows(cursors[part], [song_id for song_id, file, source in batches[part]])
+        insert_song_rows(cursors[part], part_folders[part]['id'], batches[part])
+        song_counts[part] += len(batches[part])
+        batches[part] = []
+
+    for song in (songs[song_idx] for song_idx in song_indices):
+        for part in cursors:
+            for file in song['parts'].get(part, []):
+                song_id = song_id_map[file['id']]
+                if song_id in inserted[part]:
+                    continue
+                inserted[part].add(song_id)
+                source = content_source(file)
+                if 'preferred_name' not in file:
+                    if args.verbose:
+                        print("Inserting Song [green]" + file['dest_name'] + '[/green] into database for [magenta]' + part, live=live)
+                    print("File did not have preferred name:")
+                    print(file)
+                elif args.verbose:
+                    print("Inserting Song [green]" + file['dest_name'] + '[/green] (preferred name [green]' + file['preferred_name'] + '[/green] ID=[cyan]' + str(part_folders[part]['id']) + '[/cyan]) into database for [magenta]' + part, live=live)
+                batches[part].append((song_id, file, source))
+                if song_id_map[source['id']] not in hashed[part]:
+                    hashed[part].add(song_id_map[source['id']])
+                    manifest_files[part].write(format_hashcodes_entry(part_folders[part]['id'] + '/' + source['dest_name'], source['filehash'], source.get('publishedTime', source['modifiedTime']), source['size']))
+            if len(batches[part]) >= ROW_BATCH_SIZE:
+                flush_batch(part)
+    for part in cursors:
+        flush_batch(part)
+
+    for part in cursors:
+        cursors[part].executemany("""
+        INSERT INTO SetlistSong (SetlistId, SongId)
+        VALUES (?, ?)""",
+        iter_setlist_rows(part, songs, setlists, song_id_map, live=live))
+    return song_counts
+
+# (SetlistId, SongId) rows for one instrument's setlists
+def iter_setlist_rows(part, songs, setlists, song_id_map, live=None):
+    for i in range(len(setlists)):
+        setlist = setlists[i]
+        setlist_id = i+1 # 1-indexed
+        for setlist_song_idx in setlist['song_index']:
+            setlist_song = songs[setlist_song_idx]
+            for setlist_file in setlist_song['parts'].get(part, []):
+                if args.verbose:
+                    print("Inserting Setlist Song [green]" + setlist_file['dest_name'] + "[/green] into setlist [cyan]" + setlist['name'], live=live)
+                yield setlist_id, song_id_map[setlist_file['id']]
+
+# The hashcodes manifest that MobileSheets sync reads to decide what to fetch: the path, filehash, modifiedTime and size
+# of each PDF in the part folder, one entry per part folder copy. insert_library_rows() writes them out as it goes.
+def format_hashcodes_entry(file_path, filehash, modified, size):
+    return f"{file_path}\n{filehash}\n{modified}\n{size}\n"
+
+# Folds a hashcodes file with just some songs' entries into the last published one: entries for the same path are
+# replaced where they are, the rest go at the end
+def merge_hashcodes_manifest(path, published_path):
+    updates = read_hashcodes_manifest(path)
+    with open(published_path, "r", encoding="utf-8") as published, open(path + '.tmp', "w", encoding="utf-8") as f:
+        for file_path, filehash, modified, size in iter_hashcodes_entries(published):
+            f.write(format_hashcodes_entry(file_path, *updates.pop(file_path, (filehash, modified, size))))
+        for file_path in updates:
+            f.write(format_hashcodes_entry(file_path, *updates[file_path]))
+    os.replace(path + '.tmp', path)
+
+def iter_hashcodes_entries(f):
+    for file_path in f:
+        yield file_path[:-1], f.readline()[:-1], f.readline()[:-1], f.readline()[:-1]
+
+# Reads a hashcodes file back as a dict of path to (filehash, modifiedTime, size), all strings
+def read_hashcodes_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return {file_path: (filehash, modified, size) for file_path, filehash, modified, size in iter_hashcodes_entries(f)}
+
+# Copies of the hashcodes files as they were last uploaded, to diff the next build against
+UPLOADED_MANIFESTS_DIR = 'cache/uploaded_hashcodes'
+# Same for the databases, which the early setlist publish builds on
+UPLOADED_DATABASES_DIR = 'cache/uploaded_databases'
+
+def remember_uploaded_database(db_name):
+    os.makedirs(library_path(UPLOADED_DATABASES_DIR), exist_ok=True)
+    shutil.copy(library_path('output/' + db_name), library_path(UPLOADED_DATABASES_DIR + '/' + db_name))
+
+def remember_uploaded_manifest(hashcodes_name):
+    os.makedirs(library_path(UPLOADED_MANIFESTS_DIR), exist_ok=True)
+    shutil.copy(library_path('output/' + hashcodes_name), library_path(UPLOADED_MANIFESTS_DIR + '/' + hashcodes_name))
+
+# What a tablet that synced the last upload will fetch (or drop) next time. Returns the added, changed and removed paths,
+# or None if this instrument hasn't been uploaded from here before.
+def diff_hashcodes_manifests(hashcodes_name):
+    old = read_hashcodes_manifest(library_path(UPLOADED_MANIFESTS_DIR + '/' + hashcodes_name))
+    new = read_hashcodes_manifest(library_path('output/' + hashcodes_name))
+    if old is None or new is None:
+        return None
+    added = [path for path in new if path not in old]
+    changed = [path for path in new if path in old and new[path] != old[path]]
+    removed = [path for path in old if path not in new]
+    return added, changed, removed
+
+MANIFEST_DIFF_MAX_NAMES = 10 # Per list, unless --verbose
+
+def print_manifest_diffs(instruments):
+    for instrument in sorted(instruments):
+        hashcodes_name = instrument.replace(' ','_').lower() + '_hashcodes.txt'
+        diff = diff_hashcodes_manifests(hashcodes_name)
+        if diff is None:
+            print(f"[magenta]{instrument}[/magenta]: no previous upload to compare with")
+            continue
+        added, changed, removed = diff
+        print(f"[magenta]{instrument}[/magenta]: [cyan]{len(added)}[/cyan] new, [cyan]{len(changed)}[/cyan] changed, [cyan]{len(removed)}[/cyan] removed PDFs")
+        for label, paths in [('+', added), ('~', changed), ('-', removed)]:
+            shown = paths if args.verbose else paths[:MANIFEST_DIFF_MAX_NAMES]
+            for path in shown:
+                print(f"    {label} [green]{path.split('/', 1)[-1]}")
+            if len(shown) < len(paths):
+                print(f"    {label} ...and [cyan]{len(paths) - len(shown)}[/cyan] more")
+
+# Tables with rows made by insert_song_rows() for each song, besides Songs itself
+SONG_ROW_TABLES = ['Files', 'AutoScroll', 'Crop', 'ZoomPerPage', 'MetronomeSettings', 'MetronomeBeatsPerPage']
+
+# Removes songs' rows from a database, so they can be inserted again
+def delete_song_rows(cur, song_ids):
+    rows = [(song_id,) for song_id in song_ids]
+    cur.executemany("DELETE FROM Songs WHERE Id = ?", rows)
+    for table in SONG_ROW_TABLES:
+        cur.executemany(f"DELETE FROM {table} WHERE SongId = ?", rows)
+
+# Kept outside of cache/ so --clean doesn't renumber every song on every tablet
+SONG_IDS_PATH = 'song_ids.json'
+# Per-page rows get IDs of SongId * PAGE_ID_STRIDE + page, so they stay put when other songs come and go
+PAGE_ID_STRIDE = 10000
+
+# Gives every Drive file a MobileSheets SongId that stays the same across runs, so adding one song doesn't renumber
+# every song after it in every instrument's library. New files get fresh IDs, and IDs of files that are gone are
+# retired and never handed out again. Returns a dict of Drive file ID to SongId.
+def assign_song_ids(songs):
+    mapping = load_dict(library_path(SONG_IDS_PATH)) or {'next_id': 1, 'ids': {}}
+    ids = mapping['ids']
+    current_files = set()
+    new_ids = 0
+    for song in songs:
+        for file in song['files']:
+            current_files.add(file['id'])
+            if file['id'] not in ids:
+                ids[file['id']] = mapping['next_id']
+                mapping['next_id'] += 1
+                new_ids += 1
+    retired = [file_id for file_id in ids if file_id not in current_files]
+    for file_id in retired:
+        del ids[file_id]
+    save_dict(library_path(SONG_IDS_PATH), mapping)
+    print(f"SongIds: [cyan]{new_ids}[/cyan] new, [cyan]{len(retired)}[/cyan] retired, [cyan]{len(ids)}[/cyan] total")
+    return ids
+
+# Kept outside of cache/ for the same reason as SONG_IDS_PATH
+PUBLISHED_TIMES_PATH = 'published_times.json'
+
+# Sets file['publishedTime'], the modifiedTime that goes into the Files rows and hashcodes for each source file.
+# It only moves when the content does: sync_file leaves the part folder copy alone when a newer source has the same
+# md5Checksum/size, so the databases keep the time that copy was published with and tablets see nothing new.
+def assign_published_times(songs):
+    published = load_dict(library_path(PUBLISHED_TIMES_PATH)) or {}
+    current = {}
+    def set_published_times(song_idx, song):
+        for file in song['files']:
+            source = content_source(file)
+            record = current.get(source['id']) or published.pop(source['id'], None)
+            if not record or not same_file_content(record, source):
+                record = {'md5Checksum': source.get('md5Checksum'), 'size': source['size'], 'modifiedTime': source['modifiedTime']}
+            source['publishedTime'] = record['modifiedTime']
+            current[source['id']] = record
+    update_songs(songs, set_published_times)
+    save_dict(library_path(PUBLISHED_TIMES_PATH), current)
+
 # Create a separate .db file for each part
 # We start with an empty MobileSheets database created from the app
 # This schema might change with future updates to the app, so we might have to update this script.
-def update_database(songs, setlists, part_folders):
+# instruments limits which databases get rebuilt (default is every instrument with a part).
+# If fingerprints are given, built and uploaded databases are recorded in the run journal, and ones that were
+# already built/uploaded by an interrupted run with the same fingerprint are skipped.
+# song_indices limits which songs get downloaded, counted and added to the databases, in that order (default is
+# every song). The setlist songs have to be among them.
+# With published_base, each database and hashcodes file starts out as the last published one, and only the rows for
+# the songs in song_indices (and the setlists) get replaced.
+# Returns the instruments that were built, so they can be uploaded later if upload is False.
+def update_database(songs, setlists, part_folders, instruments=None, upload=True, fingerprints=None, song_indices=None, published_base=False):
     # Create database files
     used_instruments = set()
     for song in songs:
         for part in song['parts']:
             if part not in used_instruments:
                 used_instruments.add(part)
-    with Live(log_indent + "Creating fresh databases...", console=console, refresh_per_second=4) as live:
-        clear_output_folder(live)
+    if instruments is not None:
+        used_instruments = set(instruments)
+    to_build = set(used_instruments)
+    if fingerprints:
         for instrument in used_instruments:
-            create_database(instrument, live=live)
+            db_path = library_path('output/' + instrument.replace(' ','_').lower() + '.db')
+            if journal_get('built', instrument) == fingerprints[instrument] and os.path.exists(db_path):
+                print(f"[magenta]{instrument}[/magenta] database was already built by the interrupted run")
+                to_build.remove(instrument)
+    with Live(log_indent + "Creating fresh databases...", console=console, refresh_per_second=4) as live:
+        clear_output_folder(live, to_build)
+        for instrument in to_build:
+            db_path = library_path('output/' + instrument.replace(' ','_').lower() + '.db')
+            if published_base:
+                shutil.copy(library_path(UPLOADED_DATABASES_DIR + '/' + instrument.replace(' ','_').lower() + '.db'), db_path)
+            else:
+                create_database(instrument, live=live)
 
             # Initialize setlists
-            db_path = 'output/' + instrument.replace(' ','_').lower() + '.db'
             conn = sqlite3.connect(db_path)
             cur = conn.cursor()
+            if published_base:
+                cur.execute("DELETE FROM SetlistSong")
+                cur.execute("DELETE FROM Setlists")
 
             now_ms = int(time.time() * 1000)
             for setlist in setlists:
@@ -903,147 +2031,359 @@ def update_database(songs, setlists, part_folders):
 
     # Download files to count pages
     push_log_section("[cyan]Downloading songs to count pages and assembling MobileSheets database...")
+    # Page counts from previous runs, keyed by cached PDF path
+    page_counts = load_dict(PAGE_COUNT_CACHE_PATH) or {}
+    cold_modified = {} # Cached PDF path to the Drive modifiedTime of the file it came from
+    if song_indices is None:
+        song_indices = range(len(songs))
     with Live(log_indent + "Downloading...", console=console, refresh_per_second=4) as live:
-        for song_idx in range(len(songs)):
+        for song_idx in song_indices:
             song = songs[song_idx]
             os.makedirs("cache", exist_ok=True)
             os.makedirs("cache/pdf", exist_ok=True)
             
             for file in song['files']:
-                file_name_sanitized = file['src_name'].replace(' ', '_').replace('\\', '_').replace('/','_').replace('?','')
-                file_cache_path = "cache/pdf/" + file_name_sanitized
+                # Identical PDFs are only downloaded and counted once
+                file = content_source(file)
+                file_cache_path = get_pdf_cache_path(file)
 
-                if needs_download("cache/pdf", file_name_sanitized, file["modifiedTime"]):
+                if journal_get('downloads', file_cache_path) == file['modifiedTime'] and os.path.exists(file_cache_path):
+                    if args.verbose:
+                        print('Already downloaded [green]' + file_cache_path, live=live)
+                elif needs_download("cache/pdf", os.path.basename(file_cache_path), file["modifiedTime"]):
                     print('Downloading and caching PDF to count pages for [green]' + file['src_name'], live=live)
-                    download_pdf_for_pagecount(file, "cache/pdf/" + file_name_sanitized)
+                    download_pdf_for_pagecount(file, file_cache_path)
+                    page_counts.pop(file_cache_path, None)
+                    journal_record('downloads', file_cache_path, file['modifiedTime'])
                 else:
                     if args.verbose:
-                        print('Using cached PDF for [green]' + file_name_sanitized, live=live)
-                file['pagecount'] = get_page_count(file_cache_path)
-                file['pageorder'] = '1-' + str(file['pagecount'])
+                        print('Using cached PDF for [green]' + file_cache_path, live=live)
+                cached_count = page_counts.get(file_cache_path)
+                if not cached_count or cached_count['modifiedTime'] != file['modifiedTime']:
+                    cold_modified[file_cache_path] = file['modifiedTime']
         print('Finished downloading songs!', live=live)
+
+        # Count pages for anything we don't already know about, saving as we go so an interrupted run keeps them
+        print(f'Counting pages for [cyan]{len(cold_modified)}[/cyan] PDFs...', live=live)
+        counted = 0
+        for path, page_count in count_pages(list(cold_modified)):
+            page_counts[path] = {'modifiedTime': cold_modified[path], 'pagecount': page_count}
+            counted += 1
+            if counted % JOURNAL_SAVE_EVERY == 0:
+                save_dict(PAGE_COUNT_CACHE_PATH, page_counts)
+        save_dict(PAGE_COUNT_CACHE_PATH, page_counts)
+        in_build = set(song_indices)
+        def set_page_counts(song_idx, song):
+            if song_idx not in in_build:
+                return
+            for file in song['files']:
+                file['pagecount'] = page_counts[get_pdf_cache_path(content_source(file))]['pagecount']
+                file['pageorder'] = '1-' + str(file['pagecount'])
+        update_songs(songs, set_page_counts)
+        print(f'Counted pages for [cyan]{counted}[/cyan] PDFs', live=live)
     pop_log_section()
 
-    for part in used_instruments:
-        push_log_section(f"[cyan]Assembling database for [magenta]{part}")
-        with Live(log_indent + "Opening database...", console=console, refresh_per_second=4) as live:
-            # Open database
-            db_path = 'output/' + part.replace(' ','_').lower() + '.db'
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-            # A dict of song_idx to a dict of filename to song ID
-            #   song_idx: the index of the song in our python song list
-            #   song_id: the SongId field in the MobileSheets sqlite3 database
-            song_id = 0
-            song_ids = {}
-            for song_idx in range(len(songs)):
-                song = songs[song_idx]
-                if part in song['parts']:
-                    song_ids[song_idx] = {}
-                    for file in song['parts'][part]:
-                        song_id += 1
-                        song_ids[song_idx][file['dest_name']] = song_id
-                        
-                        if 'preferred_name' not in file:
-                            if args.verbose:
-                                print("Inserting Song [green]" + file['dest_name'] + '[/green] into database [cyan]' + db_path, live=live)
-                            print("File did not have preferred name:")
-                            print(file)
-                        elif args.verbose:
-                            print("Inserting Song [green]" + file['dest_name'] + '[/green] (preferred name [green]' + file['preferred_name'] + '[/green] ID=[cyan]' + str(part_folders[part]['id']) + '[/cyan]) into database [cyan]' + db_path, live=live)
-
-                        # The file names are ugly. We can change the name in the MobileSheets database without changing the file name.
-                        cur.execute("""
-                        INSERT INTO Songs (Title, Difficulty, LastPage, OrientationLock, Duration, Stars, VerticalZoom, Sharpen, SharpenLevel, CreationDate, LastModified, Keywords, AutoStartAudio, SongId)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (file['preferred_name'], 0, 0, 0, 0, 0, 1.0, 0, 7, file['createdTime'], file['modifiedTime'], "", 0, 0))
-
-                        cur.execute("""
-                        INSERT INTO Files (SongId, Path, PageOrder, FileSize, LastModified, Source, Type, SourceFilePageCount, FileHash, Width, Height)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (song_id, part_folders[part]['id'] + '/' + file['dest_name'], file['pageorder'], file['size'], file['modifiedTime'], 1, 1, file['pagecount'], file['filehash'], -1, -1))
-
-                        cur.execute("""
-                        INSERT INTO AutoScroll (SongId, Behavior, PauseDuration, Speed, FixedDuration, ScrollPercent, ScrollOnLoad, TimeBeforeScroll)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (song_id, 0, 8000, 3, 1000, 20, 0, 2000))
-
-                        for i in range(file['pagecount']):
-                            cur.execute("""
-                            INSERT INTO Crop (SongId, Page, Left, Top, Right, Bottom, Rotation)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                            (song_id, i, 0, 0, 0, 0, 0))
-
-                        for i in range(file['pagecount']):
-                            cur.execute("""
-                            INSERT INTO ZoomPerPage (SongId, Page, Zoom, PortPanX, PortPanY, LandZoom, LandPanX, LandPanY, FirstHalfY, SecondHalfY)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                            (song_id, i, 100.0, 0, 0, 100.0, 0, 0, 0, 0))
-
-                        cur.execute("""
-                        INSERT INTO MetronomeSettings (SongId, Sig1, Sig2, Subdivision, SoundFX, AccentFirst, AutoStart, CountIn, NumberCount, AutoTurn)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (song_id, 2, 0, 0, 0, 0, 0, 0, 1, 0))
-
-                        for i in range(file['pagecount']):
-                            cur.execute("""
-                            INSERT INTO MetronomeBeatsPerPage (SongId, Page, BeatsPerPage)
-                            VALUES (?, ?, ?)""",
-                            (song_id, i, 0))
-
-                        # cur.execute("""
-                        # INSERT INTO ZoomPerPage ()
-                        # VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                        # (1, 0, 8000, 3, 1000, 20, 0, 2000))
-
-                        # Add line to hashcodes
-                        with open('output/'+part.replace(' ','_').lower() + '_hashcodes.txt', "a", encoding="utf-8") as f_out:
-                            f_out.write(f"{part_folders[part]['id']}/{file['dest_name']}\n")
-                            f_out.write(f"{file['filehash']}\n")
-                            f_out.write(f"{file['modifiedTime']}\n")
-                            f_out.write(f"{file['size']}\n")
-
-            for i in range(len(setlists)):
-                setlist = setlists[i]
-                setlist_id = i+1 # 1-indexed
-                found = False
-                for setlist_song_idx in setlist['song_index']:
-                    setlist_song = songs[setlist_song_idx]
-                    if part in setlist_song['parts']:
-                        for setlist_file in setlist_song['parts'][part]:
-                            ref_song_id = song_ids[setlist_song_idx][setlist_file['dest_name']]
-                            cur.execute("""
-                            INSERT INTO SetlistSong (SetlistId, SongId)
-                            VALUES (?, ?)""",
-                            (setlist_id, ref_song_id))
-                            found = True
-                            if args.verbose:
-                                print("Inserting Setlist Song [green]" + setlist_file['dest_name'] + "[/green] into setlist [cyan]" + setlist['name'], live=live)
-            
-            conn.commit()
-            conn.close()
-            print(f"Finished assembling database. Added [cyan]{song_id}[/cyan] songs", live=live)
-            pop_log_section()
+    song_id_map = assign_song_ids(songs)
+    assign_published_times(songs)
+    if to_build:
+        # Every database gets filled in the same pass over the songs
+        push_log_section(f"[cyan]Assembling databases for [magenta]{', '.join(sorted(to_build))}")
+        with Live(log_indent + "Opening databases...", console=console, refresh_per_second=4) as live:
+            connections = {}
+            manifest_files = {}
+            for part in to_build:
+                connections[part] = sqlite3.connect(library_path('output/' + part.replace(' ','_').lower() + '.db'))
+                manifest_files[part] = open(library_path('output/' + part.replace(' ','_').lower() + '_hashcodes.txt'), "w", encoding="utf-8")
+            cursors = {part: connections[part].cursor() for part in to_build}
+            song_counts = insert_library_rows(cursors, manifest_files, songs, setlists, part_folders, song_id_map, live=live, song_indices=song_indices, replace=published_base)
+
+            for part in sorted(to_build):
+                connections[part].commit()
+                connections[part].close()
+                manifest_files[part].close()
+                if published_base:
+                    hashcodes_name = part.replace(' ','_').lower() + '_hashcodes.txt'
+                    merge_hashcodes_manifest(library_path('output/' + hashcodes_name), library_path(UPLOADED_MANIFESTS_DIR + '/' + hashcodes_name))
+                print(f"Finished assembling [magenta]{part}[/magenta] database. Added [cyan]{song_counts[part]}[/cyan] songs", live=live)
+        pop_log_section()
+
+    # Compact the databases before they go up to the Drive
+    push_log_section("[cyan]Optimizing database size...")
+    db_sizes = {}
+    with Live(log_indent + "Optimizing...", console=console, refresh_per_second=4) as live:
+        for instrument in to_build:
+            db_path = library_path('output/' + instrument.replace(' ','_').lower() + '.db')
+            db_sizes[instrument] = optimize_database(db_path, live=live)
+            if fingerprints:
+                journal_record('built', instrument, fingerprints[instrument], flush=True)
+        print(f"Finished optimizing [cyan]{len(db_sizes)}[/cyan] databases!", live=live)
+    for instrument in sorted(db_sizes):
+        print(f"[magenta]{instrument}[/magenta]: [cyan]{db_sizes[instrument] // 1024}[/cyan] KB")
+    print(f"Total database size: [cyan]{sum(db_sizes.values()) // 1024}[/cyan] KB")
+    pop_log_section()
+
+    # A setlist-only build would just look like everything else got removed
+    if len(song_indices) == len(songs):
+        push_log_section("[cyan]Changes tablets will sync since the last upload...")
+        print_manifest_diffs(to_build)
+        pop_log_section()
 
     pop_log_section()
-    for instrument in used_instruments:
+    if upload:
+        upload_databases(used_instruments, part_folders, fingerprints)
+    return used_instruments
+
+def upload_databases(instruments, part_folders, fingerprints=None):
+    for instrument in instruments:
+        if fingerprints and journal_get('uploaded', instrument) == fingerprints[instrument]:
+            print(f"[magenta]{instrument}[/magenta] was already uploaded by the interrupted run")
+            continue
         db_name = instrument.replace(' ','_').lower() + '.db'
         hashcodes_name = instrument.replace(' ','_').lower() + '_hashcodes.txt'
         push_log_section('Uploading [cyan]output/' + db_name + '[/cyan] and [cyan]' + hashcodes_name + '[/cyan] to [green]' + instrument)
         part_folder_id = part_folders[instrument]['id']
         with Live(log_indent + "Uploading...", console=console, refresh_per_second=4) as live:
-            upload_to_drive(local_path='output/'+db_name, dest_name='mobilesheets.db', parent_folder_id = part_folder_id, live=live)
-            upload_to_drive(local_path='output/'+hashcodes_name, dest_name='mobilesheets_hashcodes.txt', parent_folder_id = part_folder_id, live=live)
+            upload_to_drive(local_path=library_path('output/'+db_name), dest_name='mobilesheets.db', parent_folder_id = part_folder_id, live=live)
+            upload_to_drive(local_path=library_path('output/'+hashcodes_name), dest_name='mobilesheets_hashcodes.txt', parent_folder_id = part_folder_id, live=live)
+            remember_uploaded_manifest(hashcodes_name)
+            remember_uploaded_database(db_name)
             print("Uploaded!", live=live)
+        if fingerprints:
+            journal_record('uploaded', instrument, fingerprints[instrument], flush=True)
         pop_log_section()
 
-try:
-    main()
-finally:
-    # Save log
-    log_indent = ''
-    print("Output saved to log.html and log.txt")
-    file_console.save_html("log.html")
-    file_console.save_text("log.txt")
-    log_path = os.path.abspath("log.html")
-    webbrowser.open(f"file://{log_path}")
\ No newline at end of file
+# Drive client for background uploads, made once and reused by every publish (only one runs at a time)
+background_drive = None
+def get_background_drive():
+    global background_drive
+    if background_drive is None:
+        background_drive = build("drive", "v3", credentials=creds)
+    return background_drive
+
+# Uploads databases from a background thread so watch mode can keep polling.
+# Uses its own Drive client and no Live display, since only one Live can be active at a time.
+# If fingerprints are given (a full build), each instrument's fingerprints and copies of its database and hashcodes
+# file are saved once it's uploaded, like a normal run does.
+# Instruments that fail to upload are logged and listed in the thread's failed_instruments, check it after join().
+def publish_in_background(instruments, part_folders, fingerprints=None, setlist_fingerprints=None):
+    failed_instruments = []
+    def publish():
+        service = get_background_drive()
+        for instrument in sorted(instruments):
+            db_name = instrument.replace(' ','_').lower() + '.db'
+            hashcodes_name = instrument.replace(' ','_').lower() + '_hashcodes.txt'
+            part_folder_id = part_folders[instrument]['id']
+            try:
+                upload_to_drive(local_path=library_path('output/'+db_name), dest_name='mobilesheets.db', parent_folder_id=part_folder_id, service=service)
+                upload_to_drive(local_path=library_path('output/'+hashcodes_name), dest_name='mobilesheets_hashcodes.txt', parent_folder_id=part_folder_id, service=service)
+            except Exception as e:
+                # Nothing gets saved for it, so the next run publishes it again
+                error(f"Couldn't publish [cyan]{db_name}[/cyan] to [magenta]{instrument}[/magenta]: {e}")
+                failed_instruments.append(instrument)
+                continue
+            print(f"Published [cyan]{db_name}[/cyan] to [magenta]{instrument}")
+            if fingerprints:
+                # Only full builds become the new baseline, an early setlist publish would hide the rest of the changes
+                remember_uploaded_manifest(hashcodes_name)
+                remember_uploaded_database(db_name)
+                save_instrument_fingerprints(fingerprints, [instrument])
+            if setlist_fingerprints:
+                save_instrument_fingerprints(setlist_fingerprints, [instrument], SETLIST_STATE_PATH)
+    thread = Thread(target=publish, daemon=True)
+    thread.failed_instruments = failed_instruments
+    thread.start()
+    return thread
+
+###############################################
+################# Watch mode ##################
+###############################################
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+def get_start_page_token():
+    return drive.changes().getStartPageToken(driveId=DRIVE_ID, supportsAllDrives=True).execute()['startPageToken']
+
+# Reads everything in the Drive changes feed since page_token. Returns the changes and the token to use next time.
+def list_drive_changes(page_token):
+    changes = []
+    while True:
+        response = drive.changes().list(
+            pageToken=page_token,
+            driveId=DRIVE_ID,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            pageSize=1000,
+            fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, parents, trashed))"
+        ).execute()
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+# Figures out which songs a batch of Drive changes touches, re-listing their files.
+# New song folders under the top level folders are appended to songs. Returns the affected songs.
+def apply_drive_changes(changes, songs, top_level_ids):
+    folder_lookup = {song['id']: song for song in songs}
+    file_lookup = {file['id']: song for song in songs for file in song['files']}
+    affected = {}
+    for change in changes:
+        file = change.get('file') or {}
+        if change['fileId'] in folder_lookup:
+            # The song folder itself changed (renamed, trashed)
+            song = folder_lookup[change['fileId']]
+            if file.get('name') and not file.get('trashed'):
+                song['name'] = file['name']
+            affected[song['id']] = song
+        if change['fileId'] in file_lookup:
+            song = file_lookup[change['fileId']]
+            affected[song['id']] = song
+        for parent_id in file.get('parents', []):
+            if parent_id in folder_lookup:
+                affected[parent_id] = folder_lookup[parent_id]
+            elif parent_id in top_level_ids and file.get('mimeType') == FOLDER_MIME_TYPE and not file.get('trashed'):
+                # A brand new song folder
+                song = {'id': file['id'], 'name': file['name'], 'files': []}
+                songs.append(song)
+                folder_lookup[song['id']] = song
+                affected[song['id']] = song
+
+    for song in affected.values():
+        song['files'] = list_pdfs_in_folder(song['id'])
+    return list(affected.values())
+
+def watch_for_changes(songs, setlists, part_folders, page_token):
+    push_log_section(f"[cyan]Watching for changes every [magenta]{args.interval}[/magenta] seconds (Ctrl-C to stop)...", rule=True)
+    top_level_ids = set()
+    for root_id in [SRC_MUSIC_FOLDER, SEASONAL_SONGS]:
+        top_level_ids.update(folder['id'] for folder in without_ignored_folders(list_folders_in_folder(root_id)))
+    agenda_revision = get_doc_revision(WEEKLY_AGENDA_ID)
+    publisher = None
+
+    while True:
+        time.sleep(args.interval)
+        processing = False
+        try:
+            changes, next_token = list_drive_changes(page_token)
+            latest_revision = get_doc_revision(WEEKLY_AGENDA_ID)
+            if not changes and latest_revision == agenda_revision:
+                page_token = next_token
+                continue
+
+            # Wait for a burst of edits to settle down before doing any work
+            while True:
+                print(f"Saw [cyan]{len(changes)}[/cyan] changes, waiting [cyan]{args.debounce}[/cyan] seconds for more...")
+                time.sleep(args.debounce)
+                more_changes, next_token = list_drive_changes(next_token)
+                newer_revision = get_doc_revision(WEEKLY_AGENDA_ID)
+                if not more_changes and newer_revision == latest_revision:
+                    break
+                changes += more_changes
+                latest_revision = newer_revision
+
+            push_log_section(f"[cyan]Processing {len(changes)} Drive changes...")
+            processing = True
+            affected_songs = apply_drive_changes(changes, songs, top_level_ids)
+            if latest_revision != agenda_revision:
+                print("[cyan]Weekly Agenda changed, re-reading setlists")
+                for setlist in setlists:
+                    affected_songs += [songs[song_idx] for song_idx in setlist['song_index']]
+                setlists[:] = query_setlist_docs({"Rehearsal": WEEKLY_AGENDA_ID}, songs)
+                for setlist in setlists:
+                    affected_songs += [songs[song_idx] for song_idx in setlist['song_index']]
+            affected_songs = list({id(song): song for song in affected_songs}.values())
+            if not affected_songs:
+                print("Nothing in the music library changed")
+                pop_log_section()
+                page_token, agenda_revision = next_token, latest_revision
+                continue
+
+            for song in affected_songs:
+                if song['files']:
+                    assemble_song_parts(song)
+                else:
+                    song['parts'] = {}
+                    song['coverage'] = {'direct': 0, 'backup': 0, 'solo': 0}
+            get_song_preferred_names(affected_songs)
+            # Editing or deleting one of two identical PDFs can hand the other one's copy back to it, even in a song that
+            # didn't change, so those songs need copying too
+            old_sources = {id(file): content_source(file)['id'] for song in songs for file in song['files']}
+            dedupe_library_content(songs)
+            affected_ids = set(id(song) for song in affected_songs)
+            moved_instruments = set()
+            for song in songs:
+                for part in song['parts']:
+                    if any(old_sources.get(id(file)) != content_source(file)['id'] for file in song['parts'][part]):
+                        moved_instruments.add(part)
+                        if id(song) not in affected_ids:
+                            affected_songs.append(song)
+                            affected_ids.add(id(song))
+            # Only the instruments that now differ from what was last published, same as a normal run. The last batch saves
+            # its fingerprints once it's uploaded, so wait for it first
+            if publisher:
+                publisher.join()
+            fingerprints = get_instrument_fingerprints(songs, setlists, part_folders)
+            affected_instruments = find_dirty_instruments(fingerprints, songs) | moved_instruments
+            print(f"Changed songs: [green]{', '.join(song['name'] for song in affected_songs)}")
+            print(f"Changed instruments: [magenta]{', '.join(sorted(affected_instruments))}")
+
+            # The part folders change as we copy into them, so list them again before copying
+            for part in affected_instruments:
+                part_folders[part]['files'] = list_pdfs_in_folder(part_folders[part]['id'])
+            copy_songlist_into_drive(affected_songs, part_folders, instruments=affected_instruments)
+            save_song_index(library_path(SONG_INDEX_PATH), songs)
+            save_dict(library_path(SETLISTS_PATH), setlists)
+            export_coverage(songs, build_coverage(songs), library_path(COVERAGE_PATH))
+
+            if not args.skipupload and affected_instruments:
+                built_instruments = update_database(songs, setlists, part_folders, instruments=affected_instruments, upload=False)
+                # So the next normal run knows these are already published
+                setlist_fingerprints = get_instrument_fingerprints(songs, setlists, part_folders, song_indices=get_setlist_song_indices(setlists))
+                publisher = publish_in_background(built_instruments, part_folders, fingerprints, setlist_fingerprints)
+            pop_log_section()
+            # Only move on once the batch went through, so a failed one gets picked up again on the next poll
+            page_token, agenda_revision = next_token, latest_revision
+        except HttpError as e:
+            error(f"Drive request failed while watching for changes, trying again in [cyan]{args.interval}[/cyan] seconds: {e}")
+            if processing:
+                pop_log_section()
+
+# Runs main() for each library config, one after another. The API clients, the crawled source folders and the
+# PDF/page count/agenda caches in cache/ are shared, everything else is kept per library (see library_path()).
+def run_libraries(config_paths):
+    # Clean download cache
+    if args.clean:
+        for config_path in config_paths:
+            load_library_config(config_path)
+            if os.path.exists(library_path('cache')):
+                shutil.rmtree(library_path('cache'))
+        if os.path.exists('cache'):
+            shutil.rmtree('cache')
+
+    for config_path in config_paths:
+        load_library_config(config_path)
+        if len(config_paths) > 1:
+            print()
+            print(f"[cyan]Library [green]{config_path}[/green] (saving to [green]{LIBRARY_DIR or '.'}[/green])", rule=True)
+        main()
+        error_log.clear()
+
+# Guarded so the page count worker processes can import this file without kicking off another run
+if __name__ == '__main__':
+    if args.watch and len(args.libraries) > 1:
+        print("[red]--watch only works with one library")
+        exit()
+    creds = get_creds()
+    docs = build("docs", "v1", credentials=creds)
+    drive = build("drive", "v3", credentials=creds)
+    try:
+        run_libraries(args.libraries)
+    finally:
+        # Keep track of how far we got, in case this was a crash or a Ctrl-C
+        flush_journal()
+        save_filehashes()
+        # Save log
+        log_indent = ''
+        print("Output saved to log.html and log.txt")
+        file_console.save_html("log.html")
+        file_console.save_text("log.txt")
+        log_path = os.path.abspath("log.html")
+        webbrowser.open(f"file://{log_path}")
\ No newline at end of file